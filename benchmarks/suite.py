@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# drives the real command callbacks (play, playlist, skip, move, remove, shuffle, seek, the queue menu)
+# and the player's track transitions without discord or youtube
+#
+#   python benchmarks/suite.py [--sizes 10,100,1000,10000,100000] [--json FILE] [--compare FILE]
+#
+# the yt_dlp job run_ytdl hands to its executor is replaced by a stand-in that serves copies of one
+# local media file (--media, or a generated tone if ffmpeg is installed), voice clients are stand-ins
+# that read 20 ms frames in real time on their own thread like nextcord's AudioPlayer does.
+# without ffmpeg the audio sources produce silent opus frames, so only the bot's own work is measured
+#
+# every number is lower-is-better, --json writes them out and --compare reports the ones that got
+# worse by more than --tolerance against an earlier run made with the same options (and exits with 1
+# if there are any), p99s of the smaller sizes come from few samples and are noisy
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import nextcord  # noqa: E402
+
+import youtubebot  # noqa: E402
+
+FRAME = 0.02  # seconds of audio per opus frame
+BOT_USER_ID = 1
+
+
+def video_id(guild_id: int, index: int) -> str:
+    # 11 characters like a youtube id, unique per benchmark guild
+    return f"{guild_id:03d}{index:08d}"
+
+
+def playlist_url(guild_id: int, count: int, duration: float) -> str:
+    return f"https://www.youtube.com/playlist?list=bench_{guild_id}_{count}_{duration}"
+
+
+class StandInExtractor:
+    # takes the place of youtubebot._run_ytdl_job, so run_ytdl, its executor and the scheduler still run
+    def __init__(self, media: str, extract_delay: float, download_delay: float):
+        self.media = media
+        self.ext = media.rsplit(".", 1)[-1]
+        self.extract_delay = extract_delay
+        self.download_delay = download_delay
+        self.durations = {}  # {guild prefix: track duration}
+
+    def __call__(self, options, action, query, cancelled):
+        if options.get("extract_flat"):
+            time.sleep(self.extract_delay)
+            listing = urllib.parse.parse_qs(urllib.parse.urlparse(query).query)["list"][
+                0
+            ]
+            _, guild_id, count, duration = listing.split("_")
+            self.durations[f"{int(guild_id):03d}"] = float(duration)
+            return {
+                "entries": [
+                    {
+                        "id": video_id(int(guild_id), i),
+                        "title": f"Benchmark track {i}",
+                        "duration": float(duration),
+                    }
+                    for i in range(int(count))
+                ]
+            }
+        if isinstance(query, dict):
+            info = query
+        else:
+            time.sleep(self.extract_delay)
+            info = self.info(youtubebot.youtube_video_id(query))
+        if action != "download":
+            return info
+        # written to a .part file over --download-ms and renamed at the end, like yt_dlp does
+        path = youtubebot.audio_cache.path_for(
+            {**info, "ext": self.ext}, youtubebot.YDL_FORMAT
+        )
+        with open(self.media, "rb") as media:
+            data = media.read()
+        chunks = 20
+        with open(path + ".part", "wb") as part:
+            for i in range(chunks):
+                time.sleep(self.download_delay / chunks)
+                part.write(
+                    data[len(data) * i // chunks : len(data) * (i + 1) // chunks]
+                )
+                part.flush()
+        os.replace(path + ".part", path)
+        return {**info, "requested_downloads": [{"ext": self.ext}]}
+
+    def info(self, vid: str):
+        return {
+            "id": vid,
+            "title": f"Benchmark track {vid}",
+            "ext": self.ext,
+            "duration": self.durations.get(vid[:3], 600.0),
+            "acodec": "opus",
+            "filesize": os.path.getsize(self.media),
+            "url": f"file://{self.media}",
+            "protocol": "file",  # never streamed, always goes through the download path
+        }
+
+
+class SilentSource:
+    # what FFmpegOpusAudio gives the player when there is no ffmpeg: opus frames for the track's duration
+    def __init__(self, track, start: float = 0.0):
+        self.remaining = int(((track.duration or 0) - start) / FRAME)
+
+    def read(self) -> bytes:
+        if self.remaining <= 0:
+            return b""
+        self.remaining -= 1
+        return youtubebot.Broadcast.SILENCE
+
+    def cleanup(self):
+        pass
+
+
+class StandInVoiceClient:
+    # reads a frame every 20 ms on its own thread and calls after() at the end, like nextcord's AudioPlayer
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.first_frame_at = None
+        self._stopped = None
+
+    def play(self, source, after=None):
+        stopped = self._stopped = threading.Event()
+        self.source = source
+
+        def run():
+            source = self.source
+            next_frame = time.perf_counter()
+            while not stopped.is_set():
+                source = self.source or source  # a seek swaps it, like nextcord allows
+                if not source.read():
+                    break
+                if self.first_frame_at is None:
+                    self.first_frame_at = time.perf_counter()
+                next_frame += FRAME
+                stopped.wait(max(0.0, next_frame - time.perf_counter()))
+            source.cleanup()
+            if self.source is source:
+                self.source = None
+            if after is not None:
+                after(None)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def is_playing(self) -> bool:
+        return self.source is not None
+
+    def is_paused(self) -> bool:
+        return False
+
+    async def disconnect(self):
+        self.stop()
+        youtubebot.bot._connection._remove_voice_client(self.channel.guild_id)
+
+
+class StandInChannel:
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.id = 1000 + guild_id
+        self.name = f"bench-{guild_id}"
+        self.members = [types.SimpleNamespace(id=BOT_USER_ID)]
+        self.voice_client = None
+
+    async def connect(self):
+        if self.voice_client is not None:
+            raise nextcord.ClientException("Already connected to a voice channel.")
+        self.voice_client = StandInVoiceClient(self)
+        youtubebot.bot._connection._add_voice_client(self.guild_id, self.voice_client)
+        return self.voice_client
+
+
+class StandInMessage:
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+
+class StandInTextChannel:
+    def __init__(self, guild_id: int):
+        self.id = 2000 + guild_id
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        message = StandInMessage(content)
+        self.messages.append(message)
+        return message
+
+
+class StandInContext:
+    def __init__(self, guild_id: int):
+        self.guild = types.SimpleNamespace(id=guild_id)
+        self.channel = StandInTextChannel(guild_id)
+        self.voice_channel = StandInChannel(guild_id)
+        self.author = types.SimpleNamespace(
+            voice=types.SimpleNamespace(channel=self.voice_channel)
+        )
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+async def settle():
+    # until the background prefetches and downloads are done
+    while youtubebot.downloads_in_flight or any(
+        player._prefetch_task is not None and not player._prefetch_task.done()
+        for player in youtubebot.players.values()
+    ):
+        await asyncio.sleep(0.005)
+
+
+def summarize(prefix: str, samples, results):
+    samples = sorted(samples)
+    results[f"{prefix}_p50_ms"] = samples[len(samples) // 2] * 1000
+    results[f"{prefix}_p99_ms"] = (
+        samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000
+    )
+    results[f"{prefix}_mean_ms"] = sum(samples) / len(samples) * 1000
+
+
+async def timed(samples, coroutine):
+    started = time.perf_counter()
+    await coroutine
+    samples.append(time.perf_counter() - started)
+
+
+async def bench_queue(guild_id: int, size: int, results):
+    ctx = StandInContext(guild_id)
+    started = time.perf_counter()
+    await youtubebot.playlist.callback(ctx, playlist_url(guild_id, size, 600.0))
+    results["playlist_enqueue_ms"] = (time.perf_counter() - started) * 1000
+    await settle()
+    player = youtubebot.players[guild_id]
+    rounds = max(5, min(500, 200000 // size))
+
+    samples = []
+    for _ in range(rounds):
+        a, b = random.randint(1, size), random.randint(1, size)
+        await timed(samples, youtubebot.move.callback(ctx, str(a), str(b)))
+    summarize("move", samples, results)
+
+    samples = []
+    for _ in range(min(rounds, size // 2)):
+        position = random.randint(1, len(player.queue) - 1)
+        await timed(samples, youtubebot.remove.callback(ctx, str(position)))
+    if samples:
+        summarize("remove", samples, results)
+
+    samples = []
+    for _ in range(max(3, rounds // 10)):
+        await timed(samples, youtubebot.shuffle.callback(ctx))
+    summarize("shuffle", samples, results)
+    await settle()
+
+    menu = youtubebot.QueueMenu(ctx, player.queue)
+    last_page = (len(player.queue) + menu.items_per_page - 1) // menu.items_per_page
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        menu._create_embed(random.randint(1, last_page))
+        samples.append(time.perf_counter() - started)
+    summarize("queue_page", samples, results)
+
+    # from the command to the next track's first frame
+    samples = []
+    for _ in range(min(10, len(player.queue) - 1)):
+        voice_client = ctx.voice_channel.voice_client
+        playing = voice_client.source
+        started = time.perf_counter()
+        await youtubebot.skip.callback(ctx)
+        while voice_client.source is playing or voice_client.source is None:
+            await asyncio.sleep(0.001)
+        samples.append(time.perf_counter() - started)
+    if samples:
+        summarize("skip", samples, results)
+
+    youtubebot.stop_player(guild_id)
+    await ctx.voice_channel.voice_client.disconnect()
+
+
+async def bench_first_audio(first_guild: int, guilds: int, results):
+    samples = []
+    for guild_id in range(first_guild, first_guild + guilds):
+        ctx = StandInContext(guild_id)
+        started = time.perf_counter()
+        await youtubebot.play.callback(ctx, f"https://youtu.be/{video_id(guild_id, 0)}")
+        while ctx.voice_channel.voice_client.first_frame_at is None:
+            await asyncio.sleep(0.001)
+        samples.append(ctx.voice_channel.voice_client.first_frame_at - started)
+        youtubebot.stop_player(guild_id)
+        await ctx.voice_channel.voice_client.disconnect()
+    summarize("play_to_first_frame", samples, results)
+
+
+async def bench_seek(guild_id: int, results):
+    # from the command to the first frame at the new position, the file is in the cache already
+    ctx = StandInContext(guild_id)
+    await youtubebot.play.callback(ctx, f"https://youtu.be/{video_id(guild_id, 0)}")
+    voice_client = ctx.voice_channel.voice_client
+    while voice_client.first_frame_at is None:
+        await asyncio.sleep(0.001)
+    samples = []
+    for position in range(1, 11):
+        playing = voice_client.source
+        started = time.perf_counter()
+        await youtubebot.seek.callback(ctx, str(position))
+        while voice_client.source is playing or voice_client.source.frames == 0:
+            await asyncio.sleep(0.001)
+        samples.append(time.perf_counter() - started)
+    summarize("seek", samples, results)
+    youtubebot.stop_player(guild_id)
+    await voice_client.disconnect()
+
+
+async def bench_transitions(guild_id: int, tracks: int, seconds: float, results):
+    ctx = StandInContext(guild_id)
+    youtubebot.transition_gaps.clear()
+    await youtubebot.playlist.callback(ctx, playlist_url(guild_id, tracks, seconds))
+    player = youtubebot.players[guild_id]
+    while len(player.queue) > 0:
+        await asyncio.sleep(0.01)
+    summarize("gap", list(youtubebot.transition_gaps) or [0.0], results)
+    youtubebot.stop_player(guild_id)
+
+
+async def bench_memory(first_guild: int, guilds: int, tracks: int, results):
+    contexts = [
+        StandInContext(guild_id)
+        for guild_id in range(first_guild, first_guild + guilds)
+    ]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for ctx in contexts:
+        await youtubebot.playlist.callback(
+            ctx, playlist_url(ctx.guild.id, tracks, 600.0)
+        )
+    await settle()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    results["bytes_per_guild"] = (after - before) / guilds
+    for ctx in contexts:
+        youtubebot.stop_player(ctx.guild.id)
+        await ctx.voice_channel.voice_client.disconnect()
+
+
+async def run(args):
+    youtubebot.bot.loop = asyncio.get_running_loop()
+    youtubebot.bot._connection.user = types.SimpleNamespace(
+        id=BOT_USER_ID, name="bench"
+    )
+    youtubebot.audio_cache.load()
+    youtubebot.metadata_cache.open()
+    youtubebot.journal.load()
+    youtubebot.journal.open()
+    youtubebot.loop_watchdog.start()
+    random.seed(0)
+
+    results = {}
+    guild_id = 1
+    for size in args.sizes:
+        results[f"queue_{size}"] = section = {}
+        print(f"queue of {size} tracks...", flush=True)
+        await bench_queue(guild_id, size, section)
+        guild_id += 1
+
+    print("play to first frame...", flush=True)
+    results["first_audio"] = section = {}
+    await bench_first_audio(guild_id, 20, section)
+    guild_id += 20
+
+    print("seek...", flush=True)
+    results["seek"] = section = {}
+    await bench_seek(guild_id, section)
+    guild_id += 1
+
+    print("track transitions...", flush=True)
+    results["transitions"] = section = {}
+    await bench_transitions(guild_id, args.gap_tracks, args.gap_track_seconds, section)
+    guild_id += 1
+
+    print("memory per guild...", flush=True)
+    results["memory"] = section = {}
+    await bench_memory(guild_id, args.guilds, args.guild_tracks, section)
+    guild_id += args.guilds
+
+    lag = youtubebot.loop_watchdog.percentiles() or {}
+    results["event_loop"] = {
+        f"lag_{name}_ms": value * 1000 for name, value in lag.items()
+    }
+    return results
+
+
+def tone(directory: str):
+    # a few seconds of opus, if ffmpeg is around to make it
+    path = os.path.join(directory, "tone.opus")
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=duration=5",
+            "-c:a",
+            "libopus",
+            path,
+        ],
+        check=True,
+    )
+    return path
+
+
+def compare(results, baseline, tolerance: float) -> int:
+    regressions = 0
+    for section, metrics in results.items():
+        for name, value in metrics.items():
+            old = baseline.get(section, {}).get(name)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            flag = ""
+            if change > tolerance:
+                flag = "  <-- regression"
+                regressions += 1
+            print(
+                f"{section + '.' + name:45} {old:14.3f} -> {value:14.3f} {change * 100:+7.1f}%{flag}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000")
+    parser.add_argument(
+        "--media", help="local audio file the stand-in extractor serves"
+    )
+    parser.add_argument("--extract-ms", type=float, default=0)
+    parser.add_argument("--download-ms", type=float, default=0)
+    parser.add_argument("--gap-tracks", type=int, default=6)
+    parser.add_argument("--gap-track-seconds", type=float, default=1.0)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--guild-tracks", type=int, default=1000)
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument(
+        "--compare", help="results of an earlier run to compare against"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+
+    # the bot keeps its cache, metadata and journal under ./dl, so everything happens in a scratch directory
+    workdir = tempfile.mkdtemp(prefix="youtubebot-bench-")
+    media = os.path.abspath(args.media) if args.media else None
+    output = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    os.chdir(workdir)
+    have_ffmpeg = shutil.which("ffmpeg") is not None
+    if media is None:
+        if have_ffmpeg:
+            media = tone(workdir)
+        else:
+            media = os.path.join(workdir, "placeholder.opus")
+            with open(media, "wb") as file:
+                file.write(os.urandom(64 * 1024))
+    if not have_ffmpeg:
+        youtubebot.create_audio_source = SilentSource
+        logging.getLogger("nextcord.player").setLevel(
+            logging.CRITICAL
+        )  # every ffprobe attempt fails
+    youtubebot._run_ytdl_job = StandInExtractor(
+        media, args.extract_ms / 1000, args.download_ms / 1000
+    )
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(
+        f"\naudio: {'ffmpeg' if have_ffmpeg else 'silent stand-in sources'}, media: {media}"
+    )
+    for section, metrics in results.items():
+        for name, value in metrics.items():
+            print(f"{section + '.' + name:45} {value:14.3f}")
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# compares how much memory a queued track costs as a full yt_dlp info dict and as a Track
+#
+#   python benchmarks/track_memory.py [--tracks N] [--info-json FILE]
+#
+# FILE can be a real dump from `yt-dlp -j <url> > info.json`, otherwise a synthetic info dict
+# shaped like what extract_info returns for a youtube video is used
+import argparse
+import copy
+import json
+import os
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import youtubebot  # noqa: E402
+
+
+def random_text(length: int) -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
+
+
+def synthetic_info(video_id: str):
+    def media_url():
+        return f"https://rr1---sn-{random_text(8)}.googlevideo.com/videoplayback?{random_text(900)}"
+
+    formats = [
+        {
+            "format_id": str(100 + i),
+            "format_note": random.choice(["low", "medium", "144p", "360p", "720p"]),
+            "ext": random.choice(["webm", "m4a", "mp4"]),
+            "protocol": "https",
+            "acodec": random.choice(["opus", "mp4a.40.2", "none"]),
+            "vcodec": random.choice(["vp9", "avc1.4d401e", "none"]),
+            "url": media_url(),
+            "width": random.choice([None, 256, 640, 1280]),
+            "height": random.choice([None, 144, 360, 720]),
+            "fps": random.choice([None, 25, 30]),
+            "abr": random.random() * 160,
+            "tbr": random.random() * 2000,
+            "filesize": random.randint(10**5, 10**8),
+            "asr": 48000,
+            "quality": random.random(),
+            "has_drm": False,
+            "source_preference": -1,
+            "audio_channels": 2,
+            "http_headers": {
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36",
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                "Accept-Language": "en-us,en;q=0.5",
+                "Sec-Fetch-Mode": "navigate",
+            },
+            "downloader_options": {"http_chunk_size": 10485760},
+            "format": f"{100 + i} - audio only",
+        }
+        for i in range(25)
+    ]
+    thumbnails = [
+        {
+            "url": f"https://i.ytimg.com/vi/{video_id}/{random_text(12)}.jpg?{random_text(60)}",
+            "preference": -i,
+            "id": str(i),
+            "height": random.choice([None, 90, 180, 360]),
+            "width": random.choice([None, 120, 320, 480]),
+        }
+        for i in range(40)
+    ]
+    captions = {
+        language: [
+            {
+                "ext": ext,
+                "url": f"https://www.youtube.com/api/timedtext?{random_text(300)}",
+            }
+            for ext in ("json3", "srv1", "srv2", "srv3", "ttml", "vtt")
+        ]
+        for language in (random_text(2) for _ in range(30))
+    }
+    return {
+        "id": video_id,
+        "title": f"Some song title ({random_text(12)})",
+        "ext": "webm",
+        "duration": random.randint(60, 3600),
+        "url": media_url(),
+        "protocol": "https",
+        "formats": formats,
+        "thumbnails": thumbnails,
+        "automatic_captions": captions,
+        "description": random_text(1500),
+        "tags": [random_text(8) for _ in range(20)],
+        "categories": ["Music"],
+        "channel": random_text(16),
+        "uploader": random_text(16),
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "http_headers": formats[0]["http_headers"],
+    }
+
+
+def fresh_copy(infos):
+    # unlike copy.deepcopy this also duplicates the strings, like separate extract_info calls would
+    return json.loads(json.dumps(infos))
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, entries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=500)
+    parser.add_argument("--info-json")
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.info_json:
+        with open(args.info_json) as file:
+            sample = json.load(file)
+        infos = [copy.deepcopy(sample) for _ in range(args.tracks)]
+        for i, info in enumerate(infos):
+            info["id"] = f"{i:011d}"
+    else:
+        infos = [synthetic_info(f"{i:011d}") for i in range(args.tracks)]
+    path = youtubebot.audio_cache.path_for
+
+    # whatever a Track doesn't keep of its info dict is freed again before measuring
+    dict_bytes, _ = measure(
+        lambda: [
+            (path(info, youtubebot.YDL_FORMAT), info) for info in fresh_copy(infos)
+        ]
+    )
+    track_bytes, _ = measure(
+        lambda: [
+            youtubebot.Track.from_info(info, path=path(info, youtubebot.YDL_FORMAT))
+            for info in fresh_copy(infos)
+        ]
+    )
+    stream_bytes, _ = measure(
+        lambda: [
+            youtubebot.Track.from_info(info, stream=True) for info in fresh_copy(infos)
+        ]
+    )
+
+    print(f"tracks: {args.tracks}")
+    print(f"(path, info dict) per track: {dict_bytes / args.tracks:10.0f} bytes")
+    print(f"Track per track:             {track_bytes / args.tracks:10.0f} bytes")
+    print(f"streamed Track per track:    {stream_bytes / args.tracks:10.0f} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# compares building a new YoutubeDL for every request with the per-worker instances _run_ytdl_job reuses
+#
+#   python benchmarks/ytdl_pool.py [--requests N]
+#
+# works offline: both sides extract the same small local file through yt_dlp's generic extractor,
+# so what's left is the setup cost of an instance (extractor classes, http session, cookies)
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import yt_dlp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import youtubebot  # noqa: E402
+
+OPTIONS = {
+    **youtubebot.YDL_OPTIONS,
+    "format": "bestaudio/best",
+    "enable_file_urls": True,
+    "quiet": True,
+}
+
+
+def fresh_instance(url: str):
+    # what _run_ytdl_job used to do
+    with yt_dlp.YoutubeDL(OPTIONS) as ydl:
+        return ydl.extract_info(url, download=False)
+
+
+def pooled_instance(url: str):
+    return youtubebot._run_ytdl_job(OPTIONS, "extract", url, threading.Event())
+
+
+def measure(job, url: str, requests: int):
+    timings = []
+    for _ in range(requests):
+        # on a ytdl worker, like the bot does it
+        started = time.perf_counter()
+        info = youtubebot.ytdl_executor.submit(job, url).result()
+        timings.append(time.perf_counter() - started)
+        assert info and info.get("id"), "extraction failed"
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "track.webm")
+        with open(path, "wb") as file:
+            file.write(os.urandom(64 * 1024))
+        url = "file://" + path
+
+        results = {}
+        for name, job in (
+            ("new instance", fresh_instance),
+            ("pooled", pooled_instance),
+        ):
+            # imports and the worker's first build of its instance aren't per request
+            measure(job, url, 1)
+            results[name] = measure(job, url, args.requests)
+
+    for name, timings in results.items():
+        print(
+            f"{name:>12}: median {statistics.median(timings) * 1000:7.2f} ms"
+            f"  mean {statistics.fmean(timings) * 1000:7.2f} ms"
+            f"  over {len(timings)} requests"
+        )
+    saved = statistics.median(results["new instance"]) - statistics.median(
+        results["pooled"]
+    )
+    print(f"saved per request: {saved * 1000:.2f} ms")
+    youtubebot.ytdl_executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,31 @@
 #!/usr/bin/env python3.10
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import io
+import json
+import math
 import os
 import re
-import shutil
+import shlex
+import sqlite3
 import subprocess as sp
 import sys
+import threading
+import time
+import traceback
 import urllib
 import urllib.parse
 import random
+import signal
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # windows, which can only run a single shard
+    fcntl = None
 
 import nextcord
 import yt_dlp
@@ -27,6 +45,105 @@ BOT_REPORT_DL_ERROR = os.getenv("BOT_REPORT_DL_ERROR", "0").lower() in (
     "t",
     "1",
 )
+PLAYBACK_MODE = os.getenv("BOT_PLAYBACK_MODE", "download").lower()
+if PLAYBACK_MODE not in ("download", "stream"):
+    print("the BOT_PLAYBACK_MODE in .env has to be either download or stream")
+    print("using default playback mode download")
+    PLAYBACK_MODE = "download"
+try:
+    PREFETCH_WINDOW = max(1, int(os.getenv("BOT_PREFETCH_WINDOW", "3")))
+except ValueError:
+    print("the BOT_PREFETCH_WINDOW in .env is not a number")
+    print("using default prefetch window of 3 tracks")
+    PREFETCH_WINDOW = 3
+try:
+    PREWARM_SECONDS = float(os.getenv("BOT_PREWARM_SECONDS", "5"))
+except ValueError:
+    print("the BOT_PREWARM_SECONDS in .env is not a number")
+    print("using default of 5 seconds")
+    PREWARM_SECONDS = 5.0
+try:
+    PROGRESSIVE_SECONDS = max(0.0, float(os.getenv("BOT_PROGRESSIVE_SECONDS", "10")))
+except ValueError:
+    print("the BOT_PROGRESSIVE_SECONDS in .env is not a number")
+    print("using default of 10 seconds")
+    PROGRESSIVE_SECONDS = 10.0
+LOUDNESS_TARGET = os.getenv("BOT_LOUDNESS_TARGET", "-14")
+try:
+    LOUDNESS_TARGET = (
+        None if LOUDNESS_TARGET.lower() == "off" else float(LOUDNESS_TARGET)
+    )
+except ValueError:
+    print("the BOT_LOUDNESS_TARGET in .env has to be a number or off")
+    print("using default target of -14 LUFS")
+    LOUDNESS_TARGET = -14.0
+try:
+    DOWNLOAD_CONCURRENCY = max(1, int(os.getenv("BOT_DOWNLOAD_CONCURRENCY", "2")))
+except ValueError:
+    print("the BOT_DOWNLOAD_CONCURRENCY in .env is not a number")
+    print("using default of 2 concurrent downloads")
+    DOWNLOAD_CONCURRENCY = 2
+try:
+    YTDL_WORKERS = max(1, int(os.getenv("BOT_YTDL_WORKERS", "4")))
+    YTDL_TIMEOUT = float(os.getenv("BOT_YTDL_TIMEOUT", "600"))
+except ValueError:
+    print("BOT_YTDL_WORKERS and BOT_YTDL_TIMEOUT in .env have to be numbers")
+    print("using defaults of 4 workers and a 600 second timeout")
+    YTDL_WORKERS = 4
+    YTDL_TIMEOUT = 600.0
+try:
+    CACHE_MAX_BYTES = int(float(os.getenv("BOT_CACHE_SIZE_MB", "2048")) * 1024 * 1024)
+except ValueError:
+    print("the BOT_CACHE_SIZE_MB in .env is not a number")
+    print("using default cache size of 2048 MB")
+    CACHE_MAX_BYTES = 2048 * 1024 * 1024
+try:
+    METADATA_TTL = float(os.getenv("BOT_METADATA_TTL_HOURS", "24")) * 3600
+    METADATA_MAX_ENTRIES = int(os.getenv("BOT_METADATA_MAX_ENTRIES", "100000"))
+except ValueError:
+    print(
+        "BOT_METADATA_TTL_HOURS and BOT_METADATA_MAX_ENTRIES in .env have to be numbers"
+    )
+    print("using defaults of 24 hours and 100000 entries")
+    METADATA_TTL = 24 * 3600.0
+    METADATA_MAX_ENTRIES = 100000
+try:
+    JOURNAL_SNAPSHOT_EVERY = max(
+        1, int(os.getenv("BOT_JOURNAL_SNAPSHOT_EVERY", "10000"))
+    )
+except ValueError:
+    print("the BOT_JOURNAL_SNAPSHOT_EVERY in .env is not a number")
+    print("using default of a snapshot every 10000 journal records")
+    JOURNAL_SNAPSHOT_EVERY = 10000
+try:
+    LOOP_LAG_THRESHOLD = float(os.getenv("BOT_LOOP_LAG_THRESHOLD_MS", "250")) / 1000
+except ValueError:
+    print("the BOT_LOOP_LAG_THRESHOLD_MS in .env is not a number")
+    print("using default threshold of 250 ms")
+    LOOP_LAG_THRESHOLD = 0.25
+try:
+    METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9464"))
+except ValueError:
+    print("the BOT_METRICS_PORT in .env is not a number")
+    print("using default port 9464")
+    METRICS_PORT = 9464
+try:
+    SHARD_COUNT = os.getenv("BOT_SHARDS", "1")
+    SHARD_COUNT = (
+        os.cpu_count() or 1
+        if SHARD_COUNT.lower() == "auto"
+        else max(1, int(SHARD_COUNT))
+    )
+except ValueError:
+    print("the BOT_SHARDS in .env has to be a number or auto")
+    print("using a single shard")
+    SHARD_COUNT = 1
+if SHARD_COUNT > 1 and fcntl is None:
+    print("running more than one shard needs file locking that isn't available here")
+    print("using a single shard")
+    SHARD_COUNT = 1
+# set by the supervisor for the shard processes it starts, None in the supervisor itself
+SHARD_ID = int(os.environ["BOT_SHARD_ID"]) if "BOT_SHARD_ID" in os.environ else None
 try:
     COLOR = int(os.getenv("BOT_COLOR", "ff0000"), 16)
 except ValueError:
@@ -37,9 +154,47 @@ except ValueError:
 bot = commands.Bot(
     command_prefix=PREFIX,
     intents=nextcord.Intents.all(),
+    # discord hands each shard its own share of the guilds
+    shard_id=SHARD_ID if SHARD_COUNT > 1 else None,
+    shard_count=SHARD_COUNT if SHARD_COUNT > 1 else None,
+    # the slash commands are the same for every shard, the first one registers them with discord
+    rollout_delete_unknown=not SHARD_ID,
+    rollout_register_new=not SHARD_ID,
+    rollout_update_known=not SHARD_ID,
+)
+# the audio cache and the metadata are shared by the shards, queues are not
+CACHE_DIR = "./dl/cache"
+METADATA_DB = "./dl/metadata.sqlite3"
+JOURNAL_DIR = "./dl/journal" if SHARD_COUNT == 1 else f"./dl/journal/shard-{SHARD_ID}"
+players = {}  # {server_id: GuildPlayer}
+stations = {}  # {name: GuildPlayer playing into a Broadcast}
+tuned_in = {}  # {server_id: name of the station its voice client listens to}
+channel_statuses = {}  # {text channel id: ChannelStatus}
+playback_modes = {}
+loop_modes = (
+    {}
+)  # {server_id: loop mode} while nothing plays there, the next player starts with it
+metadata_refreshes = set()
+downloads_in_flight = {}  # {(video_id, format): future of (path, info)}
+coalesced_downloads = 0
+download_failures = 0
+metrics_server = None
+exit_reason = None  # why a shard stopped, for the supervisor to start it again
+restored_state = (
+    None  # what the journal had when we started, until on_ready restores it
+)
+transition_gaps = collections.deque(maxlen=200)  # seconds of silence between tracks
+ffmpeg_cpu_usage = collections.deque(
+    maxlen=200
+)  # (copied the opus packets, cpu seconds, audio seconds) per finished ffmpeg
+loudness_pending = set()  # paths being measured or rewritten
+# paths that couldn't be measured or rewritten, they're tried again on the next run
+loudness_skipped = set()
+loudness_slots = asyncio.Semaphore(1)  # background work, one file at a time is plenty
+# yt_dlp is fully synchronous, so every extraction and download runs here instead of on the event loop
+ytdl_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=YTDL_WORKERS, thread_name_prefix="ytdl"
 )
-queues = {}  # {server_id: [(vid_file, info), ...]}
-loop_modes = {}
 
 
 def main():
@@ -48,10 +203,2192 @@ def main():
             "No token provided. Please create a .env file containing the token.\n"
             "For more information view the README.md"
         )
+    if SHARD_ID is None:
+        return supervise()
+    global restored_state
+    audio_cache.load()
+    metadata_cache.open()
+    restored_state = journal.load()
+    journal.open()
     try:
         bot.run(TOKEN)
     except nextcord.PrivilegedIntentsRequired as error:
         return error
+    return exit_reason
+
+
+def supervise():
+    # runs every shard in a process of its own and starts a shard again when it dies, the others keep playing
+    # a shard that keeps dying right after starting is started again less and less often, up to once a minute
+    workers = {}  # {shard id: (process, monotonic time it started)}
+    restarts = {}  # {shard id: monotonic time to start it again}
+    # {shard id: deaths in a row that came soon after starting}
+    failures = collections.Counter()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    def start(shard_id: int):
+        env = {
+            **os.environ,
+            "BOT_SHARD_ID": str(shard_id),
+            "BOT_SHARDS": str(SHARD_COUNT),
+        }
+        process = sp.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        workers[shard_id] = (process, time.monotonic())
+        print(f"started shard {shard_id} of {SHARD_COUNT} as process {process.pid}")
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for shard_id in range(SHARD_COUNT):
+        start(shard_id)
+    while not stopping:
+        time.sleep(0.5)
+        now = time.monotonic()
+        for shard_id, (process, started) in list(workers.items()):
+            if process.poll() is None:
+                continue
+            del workers[shard_id]
+            failures[shard_id] = failures[shard_id] + 1 if now - started < 60 else 0
+            delay = min(60, 2 ** failures[shard_id] - 1)
+            print(
+                f"shard {shard_id} exited with {process.returncode}, starting it again in {delay}s"
+            )
+            restarts[shard_id] = now + delay
+        for shard_id, at in list(restarts.items()):
+            if at <= now:
+                del restarts[shard_id]
+                start(shard_id)
+
+    for process, _ in workers.values():
+        process.terminate()
+    for process, _ in workers.values():
+        try:
+            process.wait(10)
+        except sp.TimeoutExpired:
+            process.kill()
+
+
+class AudioCache:
+    # downloaded audio shared by every guild, one file per (video id, format)
+    # files referenced by a queue are never evicted, the rest are dropped least recently used first
+    # the shards share the directory, each takes a shared byte range lock on a file it references and an
+    # exclusive one to evict or download it, so they never delete or write a file another one is using
+    DOWNLOADS = 1 << 32  # where the download locks start, below are the file locks
+    REWRITES = 2 << 32  # and where the locks for rewriting a finished file start
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = (
+            collections.OrderedDict()
+        )  # {stem: (path, size, info)}, oldest first
+        self._refs = collections.Counter()  # {path: number of queue entries using it}
+        self._held = (
+            collections.Counter()
+        )  # {lock offset: number of reasons to hold it}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    @staticmethod
+    def format_key(ydl_format: str) -> str:
+        return re.sub(r"[^A-Za-z0-9]+", "_", ydl_format).strip("_")
+
+    @staticmethod
+    def describe(info):
+        # loudness and peak are measured, gain is how much of it is already written into the file
+        return {
+            k: info.get(k)
+            for k in (
+                "id",
+                "title",
+                "ext",
+                "duration",
+                "acodec",
+                "abr",
+                "loudness",
+                "peak",
+                "gain",
+            )
+        }
+
+    def _stem(self, video_id: str, ydl_format: str) -> str:
+        return f"{self.directory}/{video_id}.{self.format_key(ydl_format)}"
+
+    def outtmpl(self, ydl_format: str) -> str:
+        return f"%(id)s.{self.format_key(ydl_format)}.%(ext)s"
+
+    def path_for(self, info, ydl_format: str) -> str:
+        return f'{self._stem(info["id"], ydl_format)}.{info["ext"]}'
+
+    @staticmethod
+    def _read_sidecar(stem: str):
+        try:
+            with open(f"{stem}.json") as file:
+                info = json.load(file)
+            path = f'{stem}.{info["ext"]}'
+            stat = os.stat(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return stat.st_mtime, path, stat.st_size, info
+
+    def load(self):
+        # pick up whatever survived the last run, using mtime as the recency order
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is not None:
+            self._lock_file = os.open(
+                f"{self.directory}/.locks", os.O_RDWR | os.O_CREAT
+            )
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            stem = f'{self.directory}/{name[:-len(".json")]}'
+            sidecar = self._read_sidecar(stem)
+            if sidecar is not None:
+                found.append((stem, *sidecar))
+        with self._lock:
+            for stem, _, path, size, info in sorted(found, key=lambda entry: entry[1]):
+                self._entries[stem] = (path, size, info)
+                self._size += size
+        self.evict()
+
+    def _offset(self, name: str) -> int:
+        # the same for every shard, unlike hash()
+        return zlib.crc32(os.path.basename(name).encode())
+
+    def _hold(self, offset: int, exclusive: bool = False) -> bool:
+        # with self._lock held, a lock other shards see, within this process they're only counted
+        if self._held[offset] == 0 and self._lock_file is not None:
+            try:
+                fcntl.lockf(
+                    self._lock_file,
+                    fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH,
+                    1,
+                    offset,
+                )
+            except OSError:
+                return False
+        self._held[offset] += 1
+        return True
+
+    def _drop(self, offset: int):
+        # with self._lock held
+        self._held[offset] -= 1
+        if self._held[offset] <= 0:
+            del self._held[offset]
+            if self._lock_file is not None:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, offset)
+
+    def _ref(self, path: str):
+        # with self._lock held, waits out another shard that is evicting the file right now
+        if self._refs[path] == 0:
+            self._hold(self._offset(path))
+        self._refs[path] += 1
+
+    def _unref(self, path: str):
+        # with self._lock held
+        self._refs[path] -= 1
+        if self._refs[path] <= 0:
+            del self._refs[path]
+            self._drop(self._offset(path))
+
+    def _find(self, stem: str):
+        # with self._lock held, another shard may have downloaded it since we looked at the directory
+        if stem not in self._entries:
+            sidecar = self._read_sidecar(stem)
+            if sidecar is None:
+                return None
+            _, path, size, info = sidecar
+            self._entries[stem] = (path, size, info)
+            self._size += size
+        return self._entries[stem]
+
+    def _forget(self, stem: str):
+        # with self._lock held, for a file another shard evicted
+        self._size -= self._entries.pop(stem)[1]
+
+    def find(self, video_id: str, ydl_format: str):
+        # like lookup, without taking a reference or counting as a hit or a miss
+        with self._lock:
+            entry = self._find(self._stem(video_id, ydl_format))
+        return None if entry is None else (entry[0], entry[2])
+
+    def lookup(self, video_id: str, ydl_format: str):
+        # a hit also takes a reference, so the file can't be evicted before it is queued
+        stem = self._stem(video_id, ydl_format)
+        with self._lock:
+            entry = self._find(stem)
+            if entry is not None:
+                path, _, info = entry
+                self._ref(path)
+                if os.path.exists(path):
+                    self._entries.move_to_end(stem)
+                    self.hits += 1
+                    return path, info
+                self._unref(path)
+                self._forget(stem)
+            self.misses += 1
+            return None
+
+    def add(self, path: str, info):
+        # registers a finished download and takes a reference to it
+        info = self.describe(info)
+        stem = path[: -len(info["ext"]) - 1]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            if (
+                stem in self._entries
+            ):  # someone else's request for the same download got here first
+                self._entries.move_to_end(stem)
+            else:
+                self._entries[stem] = (path, size, info)
+                self._size += size
+            self._ref(path)
+        self.evict()
+
+    def write_sidecar(self, path: str, info):
+        # what the next run and the other shards find the file by
+        # replaced rather than rewritten, so another shard never reads half of it
+        stem = path.rsplit(".", 1)[0]
+        written = f"{stem}.json.{os.getpid()}.tmp"
+        try:
+            with open(written, "w") as file:
+                json.dump(self.describe(info), file)
+            os.replace(written, f"{stem}.json")
+        except OSError:
+            pass
+
+    def info(self, path: str):
+        with self._lock:
+            entry = self._entries.get(path.rsplit(".", 1)[0])
+        return None if entry is None else entry[2]
+
+    def reread(self, path: str):
+        # the info as the sidecar has it now, another shard may have changed the file since we read it
+        stem = path.rsplit(".", 1)[0]
+        sidecar = self._read_sidecar(stem)
+        with self._lock:
+            if sidecar is None:
+                return None
+            _, path, size, info = sidecar
+            if stem in self._entries:
+                self._size -= self._entries[stem][1]
+            self._entries[stem] = (path, size, info)
+            self._size += size
+        return info
+
+    def update(self, path: str, **changes):
+        # keeps what was worked out about a file with it, so it's never worked out again
+        stem = path.rsplit(".", 1)[0]
+        with self._lock:
+            entry = self._find(stem)
+            if entry is None:
+                return None
+            _, size, info = entry
+            info = {**info, **changes}
+            try:
+                new_size = os.path.getsize(path)  # a rewrite changes it
+            except OSError:
+                new_size = size
+            self._entries[stem] = (path, new_size, info)
+            self._size += new_size - size
+        self.write_sidecar(path, info)
+        return info
+
+    def lock_download(self, video_id: str, ydl_format: str) -> bool:
+        # false while another shard is downloading the same file
+        offset = self.DOWNLOADS + self._offset(self._stem(video_id, ydl_format))
+        with self._lock:
+            return self._hold(offset, exclusive=True)
+
+    def unlock_download(self, video_id: str, ydl_format: str):
+        offset = self.DOWNLOADS + self._offset(self._stem(video_id, ydl_format))
+        with self._lock:
+            self._drop(offset)
+
+    def lock_rewrite(self, path: str) -> bool:
+        # false while another shard is rewriting the file
+        with self._lock:
+            return self._hold(self.REWRITES + self._offset(path), exclusive=True)
+
+    def unlock_rewrite(self, path: str):
+        with self._lock:
+            self._drop(self.REWRITES + self._offset(path))
+
+    def acquire(self, path: str):
+        with self._lock:
+            self._ref(path)
+
+    def release(self, path: str):
+        with self._lock:
+            self._unref(path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return  # the usual case, no need to walk the entries
+            for stem, (path, size, _) in list(self._entries.items()):
+                if self._size <= self.max_bytes:
+                    break
+                offset = self._offset(path)
+                # a file of ours shares the lock, or another shard is using it
+                if self._held[offset] > 0 or not self._hold(offset, exclusive=True):
+                    continue
+                del self._entries[stem]
+                self._size -= size
+                for stale in (path, f"{stem}.json"):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                self._drop(offset)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(self._entries),
+                "bytes": self._size,
+                "normalized": sum(
+                    info.get("gain") is not None
+                    for _, _, info in self._entries.values()
+                ),
+            }
+
+
+audio_cache = AudioCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+
+class TitleIndex:
+    # titles and ids the bot has seen, for autocomplete without asking youtube
+    # every word maps to the entries it's in, and the words are kept sorted so a prefix is a bisect range
+    WALK_ABOVE = (
+        2000  # more candidates than this are found walking from the most recently used
+    )
+
+    def __init__(self):
+        # {id: (title, used_at, its words joined by spaces)}, least recently used first
+        self._entries = collections.OrderedDict()
+        self._postings = collections.defaultdict(set)  # {word: ids}
+        self._words = []  # sorted
+
+    @staticmethod
+    def words(text: str):
+        return re.findall(r"\w+", text.casefold())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, entry_id: str, title: str, used_at: float):
+        # used_at is the newest yet, except when loading in order of it
+        old = self._entries.get(entry_id)
+        if old is not None and old[0] == title:
+            self.touch(entry_id, used_at)
+            return
+        if old is not None:  # renamed
+            for word in old[2].split():
+                self._postings[word].discard(entry_id)
+        words = self.words(title)
+        self._entries[entry_id] = (title, used_at, " ".join(words))
+        self._entries.move_to_end(entry_id)
+        for word in set(words) | {entry_id.casefold()}:
+            if word not in self._postings:
+                bisect.insort(self._words, word)
+            self._postings[word].add(entry_id)
+
+    def remove(self, entry_id: str):
+        old = self._entries.pop(entry_id, None)
+        if old is None:
+            return
+        for word in set(old[2].split()) | {entry_id.casefold()}:
+            self._postings[word].discard(entry_id)
+            if not self._postings[word]:
+                del self._postings[word]
+                self._words.pop(bisect.bisect_left(self._words, word))
+
+    def touch(self, entry_id: str, used_at: float):
+        if entry_id in self._entries:
+            title, _, key = self._entries[entry_id]
+            self._entries[entry_id] = (title, used_at, key)
+            self._entries.move_to_end(entry_id)
+
+    def _matching(self, prefix: str):
+        # ids with a word starting with prefix
+        start = bisect.bisect_left(self._words, prefix)
+        end = bisect.bisect_left(self._words, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return set().union(*(self._postings[word] for word in self._words[start:end]))
+
+    def suggest(self, query: str, limit: int = 25):
+        # -> [(id, title)] with a word starting with each word of the query
+        # titles starting with the query come first, then the most recently used
+        prefixes = self.words(query)
+        start = " ".join(prefixes)
+        candidates = (
+            set.intersection(*map(self._matching, prefixes)) if prefixes else None
+        )
+        if candidates is not None and len(candidates) <= self.WALK_ABOVE:
+
+            def rank(entry_id):
+                _, used_at, key = self._entries[entry_id]
+                return key.startswith(start), used_at
+
+            best = heapq.nlargest(limit, candidates, key=rank)
+            return [(entry_id, self._entries[entry_id][0]) for entry_id in best]
+        # most of the index matches, so the best ones are among the recently used
+        first, rest = [], []
+        for entry_id in reversed(self._entries):
+            if candidates is not None and entry_id not in candidates:
+                continue
+            title, _, key = self._entries[entry_id]
+            if key.startswith(start):
+                first.append((entry_id, title))
+                if len(first) == limit:
+                    break
+            elif len(rest) < limit:
+                rest.append((entry_id, title))
+        return (first + rest)[:limit]
+
+
+class MetadataCache:
+    # what extract_info told us about videos, and which video a search query led to, kept across restarts
+    # entries older than the ttl are still returned (flagged as stale) so the caller can refresh them in the background
+    def __init__(self, database: str, ttl: float, max_entries: int):
+        self.database = database
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._db = None
+        self._writes = 0
+        self.videos = (
+            TitleIndex()
+        )  # what autocomplete suggests, loaded from and kept up with the database
+        self.playlists = TitleIndex()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.database), exist_ok=True)
+        self._db = sqlite3.connect(self.database)
+        # wal without fsync on every commit, losing the last few entries on a power cut is fine for a cache
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS videos (
+                id TEXT PRIMARY KEY, title TEXT, ext TEXT, duration REAL,
+                fetched_at REAL, used_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT PRIMARY KEY, video_id TEXT, fetched_at REAL, used_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY, title TEXT, used_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS videos_used_at ON videos (used_at);
+            CREATE INDEX IF NOT EXISTS searches_used_at ON searches (used_at);
+            """)
+        # videos only listed in a playlist have no ext, those haven't been played
+        for row in self._db.execute(
+            "SELECT id, title, used_at FROM videos "
+            "WHERE ext IS NOT NULL AND title IS NOT NULL ORDER BY used_at"
+        ):
+            self.videos.add(*row)
+        for row in self._db.execute(
+            "SELECT id, title, used_at FROM playlists ORDER BY used_at"
+        ):
+            self.playlists.add(*row)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def video(self, video_id: str):
+        # -> (info dict with id, title, ext and duration, is stale) or (None, False)
+        if self._db is None:
+            return None, False
+        row = self._db.execute(
+            "SELECT id, title, ext, duration, fetched_at FROM videos WHERE id = ?",
+            (video_id,),
+        ).fetchone()
+        if row is None:
+            return None, False
+        now = time.time()
+        self._db.execute("UPDATE videos SET used_at = ? WHERE id = ?", (now, video_id))
+        self._db.commit()
+        self.videos.touch(video_id, now)
+        info = {"id": row[0], "title": row[1], "ext": row[2], "duration": row[3]}
+        return info, time.time() - row[4] > self.ttl
+
+    def search(self, query: str):
+        # -> (video id, is stale) or (None, False)
+        if self._db is None:
+            return None, False
+        query = self.normalize(query)
+        row = self._db.execute(
+            "SELECT video_id, fetched_at FROM searches WHERE query = ?", (query,)
+        ).fetchone()
+        if row is None:
+            return None, False
+        self._db.execute(
+            "UPDATE searches SET used_at = ? WHERE query = ?", (time.time(), query)
+        )
+        self._db.commit()
+        return row[0], time.time() - row[1] > self.ttl
+
+    def store(self, info, search: str = None):
+        if self._db is None:
+            return
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                info["id"],
+                info.get("title"),
+                info.get("ext"),
+                info.get("duration"),
+                now,
+                now,
+            ),
+        )
+        if search is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)",
+                (self.normalize(search), info["id"], now, now),
+            )
+        self._db.commit()
+        if info.get("title"):
+            self.videos.add(info["id"], info["title"], now)
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def remember(self, infos):
+        # bulk insert of what a flat playlist extraction knows, without overwriting fuller entries
+        if self._db is None:
+            return
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR IGNORE INTO videos VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    info["id"],
+                    info.get("title"),
+                    info.get("ext"),
+                    info.get("duration"),
+                    now,
+                    now,
+                )
+                for info in infos
+            ],
+        )
+        self._db.commit()
+        self.prune()
+
+    def store_playlist(self, info):
+        if self._db is None or not info.get("id") or not info.get("title"):
+            return
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)",
+            (info["id"], info["title"], now),
+        )
+        self._db.commit()
+        self.playlists.add(info["id"], info["title"], now)
+
+    def prune(self):
+        # drop the least recently used rows beyond max_entries, autocomplete forgets them too
+        for table, key, index in (
+            ("videos", "id", self.videos),
+            ("searches", "query", None),
+            ("playlists", "id", self.playlists),
+        ):
+            removed = self._db.execute(
+                f"SELECT {key} FROM {table} ORDER BY used_at DESC LIMIT -1 OFFSET ?",
+                (self.max_entries,),
+            ).fetchall()
+            self._db.executemany(f"DELETE FROM {table} WHERE {key} = ?", removed)
+            if index is not None:
+                for (entry_id,) in removed:
+                    index.remove(entry_id)
+        self._db.commit()
+
+
+metadata_cache = MetadataCache(METADATA_DB, METADATA_TTL, METADATA_MAX_ENTRIES)
+
+# opus is what discord wants, so ffmpeg can pass it through instead of re-encoding every track in real time
+YDL_FORMAT = "worstaudio[acodec=opus]/worstaudio"
+# source address as 0.0.0.0 to force ipv4 because ipv6 breaks it for some reason
+# this is equivalent to --force-ipv4 (line 312 of https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/options.py)
+YDL_OPTIONS = {
+    "format": YDL_FORMAT,
+    "source_address": "0.0.0.0",
+    "default_search": "ytsearch",
+    "outtmpl": audio_cache.outtmpl(YDL_FORMAT),
+    "noplaylist": True,
+    "ignoreerrors": True,
+    "allow_playlist_files": False,
+    # 'progress_hooks': [lambda info, ctx=ctx: video_progress_hook(ctx, info)],
+    # 'match_filter': lambda info, incomplete, will_need_search=will_need_search, ctx=ctx: start_hook(ctx, info, incomplete, will_need_search),
+    "paths": {"home": CACHE_DIR},
+    # anything that isn't opus gets converted once here, opus only gets remuxed into an .opus file
+    "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "opus"}],
+}
+# only lists what a playlist contains, the entries get resolved one by one when they come up
+YDL_PLAYLIST_OPTIONS = {"extract_flat": "in_playlist", "simulate": True}
+# lets ffmpeg ride out dropped connections while streaming straight from youtube
+STREAM_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+
+class Journal:
+    # every guild's queue and loop mode, so a restart can carry on where the last run stopped
+    # changes are appended to json lines segments as they happen and folded into a snapshot every so often
+    # tracks are kept as (id, title, duration), the audio files are found again in the cache by id
+    # the position in the playing track is kept as (id, seconds), it's only used if that track is still first
+    ADD_CHUNK = (
+        1000  # tracks per add record, a long playlist is written a bit at a time
+    )
+
+    def __init__(self, directory: str, snapshot_every: int):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self._seq = 0  # number of the last record written
+        self._file = None
+        self._segment_records = 0
+        self._snapshotting = False
+        self._snapshot_due = False
+
+    @staticmethod
+    def encode(tracks):
+        return [[track.id, track.title, track.duration] for track in tracks]
+
+    @staticmethod
+    def decode(tracks):
+        return [
+            Track(video_id, title, duration=duration)
+            for video_id, title, duration in tracks
+        ]
+
+    def _segments(self):
+        return sorted(
+            f"{self.directory}/{name}"
+            for name in os.listdir(self.directory)
+            if name.startswith("journal-") and name.endswith(".jsonl")
+        )
+
+    def load(self):
+        # -> {server_id: {"channel": voice channel id, "loop": mode, "queue": TrackQueue, "position": [id, seconds]}}
+        os.makedirs(self.directory, exist_ok=True)
+        state = {}
+        snapshot_seq = 0
+        try:
+            with open(f"{self.directory}/snapshot.json") as file:
+                snapshot = json.load(file)
+            snapshot_seq = snapshot["seq"]
+            for server_id, saved in snapshot["guilds"].items():
+                state[int(server_id)] = {
+                    "channel": saved["channel"],
+                    "loop": saved["loop"],
+                    "queue": TrackQueue(self.decode(saved["tracks"])),
+                    "position": saved.get("position"),
+                }
+        except (OSError, ValueError, KeyError):
+            pass
+        self._seq = snapshot_seq
+        for segment in self._segments():
+            with open(segment) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # cut off by a crash mid-write
+                    self._seq = max(self._seq, record["n"])
+                    if (
+                        record["n"] > snapshot_seq
+                    ):  # older ones are in the snapshot already
+                        self._apply(state, record["g"], record["op"], record["a"])
+        return state
+
+    def _apply(self, state, server_id, op: str, args):
+        if op == "start":
+            state[server_id] = {
+                "channel": args[0],
+                "loop": "off",
+                "queue": TrackQueue(),
+                "position": None,
+            }
+            return
+        if op == "end":
+            state.pop(server_id, None)
+            return
+        saved = state.get(server_id)
+        if saved is None:
+            return
+        if op == "add":
+            saved["queue"].extend(self.decode(args[0]))
+        elif op == "del":
+            saved["queue"].delete(args[0], args[1])
+        elif op == "move":
+            saved["queue"].move(args[0], args[1])
+        elif op == "shuffle":
+            saved["queue"].shuffle(args[0], args[1])
+        elif op == "set":
+            saved["queue"] = TrackQueue(self.decode(args[0]))
+        elif op == "loop":
+            saved["loop"] = args[0]
+        elif op == "pos":
+            saved["position"] = args
+
+    def open(self):
+        # starts a new segment, whatever is in the old ones stays until the next snapshot
+        self._file = open(
+            f"{self.directory}/journal-{self._seq + 1:012d}.jsonl",
+            "a",
+            encoding="utf-8",
+        )
+        self._segment_records = 0
+
+    def record(self, server_id, op: str, *args):
+        if self._file is None:
+            return
+        self._seq += 1
+        self._file.write(
+            json.dumps(
+                {"n": self._seq, "g": server_id, "op": op, "a": args},
+                separators=(",", ":"),
+            )
+            + "\n"
+        )
+        # flushed to the os right away, a crash or restart of the bot doesn't lose it (a power cut might)
+        self._file.flush()
+        self._segment_records += 1
+        if self._segment_records >= self.snapshot_every and not self._snapshot_due:
+            # taken on the next turn of the loop, once the change behind this record is in place (a new player records start before it's in players)
+            self._snapshot_due = True
+            bot.loop.call_soon(self.snapshot)
+
+    def snapshot(self):
+        # on the event loop, the state is taken here and written out in the background
+        self._snapshot_due = False
+        if self._file is None or self._snapshotting:
+            return
+        guilds = {
+            server_id: {
+                "channel": player.connection.channel.id,
+                "loop": player.loop_mode,
+                "tracks": self.encode(player.queue),
+                "position": (
+                    [player.queue[0].id, round(player.position, 1)]
+                    if len(player.queue) > 0
+                    else None
+                ),
+            }
+            for server_id, player in players.items()
+            if player.journaled
+        }
+        seq = self._seq
+        folded = self._segments()
+        self._file.close()
+        self.open()
+        self._snapshotting = True
+
+        def write():
+            try:
+                with open(f"{self.directory}/snapshot.json.tmp", "w") as file:
+                    json.dump(
+                        {"seq": seq, "guilds": guilds}, file, separators=(",", ":")
+                    )
+                os.replace(
+                    f"{self.directory}/snapshot.json.tmp",
+                    f"{self.directory}/snapshot.json",
+                )
+                for segment in folded:
+                    os.remove(segment)
+            except OSError as err:
+                print(f"failed to write the journal snapshot: {err}")
+            finally:
+                self._snapshotting = False
+
+        bot.loop.run_in_executor(None, write)
+
+
+journal = Journal(JOURNAL_DIR, JOURNAL_SNAPSHOT_EVERY)
+
+
+class Track:
+    # what a queue entry needs, instead of the whole yt_dlp info dict with every format and thumbnail
+    # ids, titles and stream headers repeat a lot across guilds and looped queues, so they're interned
+    __slots__ = (
+        "id",
+        "title",
+        "ext",
+        "duration",
+        "path",
+        "stream_url",
+        "stream_headers",
+        "codec",
+        "download",
+    )
+
+    def __init__(
+        self,
+        video_id: str,
+        title: str,
+        ext: str = None,
+        duration: float = None,
+        path: str = None,
+        stream_url: str = None,
+        stream_headers: str = None,
+        codec: str = None,
+        download=None,
+    ):
+        self.id = sys.intern(video_id)
+        self.title = sys.intern(title or video_id)
+        self.ext = sys.intern(ext) if ext is not None else None
+        self.duration = duration
+        self.path = path  # local file, None while unresolved or when streamed
+        self.stream_url = stream_url
+        self.stream_headers = sys.intern(stream_headers) if stream_headers else None
+        self.codec = (
+            sys.intern(codec) if codec else None
+        )  # of the audio, "opus" is played without re-encoding
+        # PartialDownload while it's played before the download finished
+        self.download = download
+
+    @classmethod
+    def from_info(cls, info, path: str = None, stream: bool = False, download=None):
+        if not stream:
+            return cls(
+                info["id"],
+                info.get("title"),
+                info.get("ext"),
+                info.get("duration"),
+                path,
+                codec=info.get("acodec"),
+                download=download,
+            )
+        # ffmpeg wants the extractor's headers as one "key: value\r\n" string
+        headers = "".join(
+            f"{k}: {v}\r\n" for k, v in info.get("http_headers", {}).items()
+        )
+        return cls(
+            info["id"],
+            info.get("title"),
+            info.get("ext"),
+            info.get("duration"),
+            stream_url=info["url"],
+            stream_headers=headers,
+            codec=info.get("acodec"),
+        )
+
+    @property
+    def resolved(self) -> bool:
+        return (
+            self.path is not None
+            or self.stream_url is not None
+            or self.download is not None
+        )
+
+    @property
+    def link(self) -> str:
+        return f"https://youtu.be/{self.id}"
+
+    def unresolved(self):
+        # what's needed to show a track in the queue and to resolve it later
+        return Track(self.id, self.title, duration=self.duration)
+
+
+class _QueueNode:
+    __slots__ = ("entry", "priority", "size", "left", "right")
+
+    def __init__(self, entry, priority: float):
+        self.entry = entry
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+
+def _size(node) -> int:
+    return node.size if node is not None else 0
+
+
+class TrackQueue:
+    # a list of queue entries backed by an implicit treap (a randomly balanced tree ordered by position),
+    # so positional inserts, removals and moves cost O(log n) instead of shifting the whole list
+
+    def __init__(self, entries=()):
+        self._root = self._build(list(entries))
+
+    @staticmethod
+    def _build(entries):
+        # cartesian tree over random priorities, O(n) instead of n separate inserts
+        stack = []
+        for entry in entries:
+            node = _QueueNode(entry, random.random())
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        if not stack:
+            return None
+        TrackQueue._resize(stack[0])
+        return stack[0]
+
+    @staticmethod
+    def _resize(root):
+        # recompute sizes bottom-up without recursion, only needed after _build
+        order = []
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            order.append(node)
+            pending.extend(
+                child for child in (node.left, node.right) if child is not None
+            )
+        for node in reversed(order):
+            node.size = 1 + _size(node.left) + _size(node.right)
+
+    @staticmethod
+    def _split(node, count):
+        # -> (first count entries, the rest)
+        if node is None:
+            return None, None
+        if _size(node.left) >= count:
+            left, node.left = TrackQueue._split(node.left, count)
+            node.size = 1 + _size(node.left) + _size(node.right)
+            return left, node
+        node.right, right = TrackQueue._split(node.right, count - _size(node.left) - 1)
+        node.size = 1 + _size(node.left) + _size(node.right)
+        return node, right
+
+    @staticmethod
+    def _merge(left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = TrackQueue._merge(left.right, right)
+            left.size = 1 + _size(left.left) + _size(left.right)
+            return left
+        right.left = TrackQueue._merge(left, right.left)
+        right.size = 1 + _size(right.left) + _size(right.right)
+        return right
+
+    def _node_at(self, index: int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def _iter_range(self, start: int, stop: int):
+        # in-order walk that skips whole subtrees before start, O(log n + stop - start)
+        stack = []
+        node = self._root
+        index = start
+        while node is not None:
+            left_size = _size(node.left)
+            if index < left_size:
+                stack.append(node)
+                node = node.left
+            elif index == left_size:
+                stack.append(node)
+                break
+            else:
+                index -= left_size + 1
+                node = node.right
+        remaining = stop - start
+        while stack and remaining > 0:
+            node = stack.pop()
+            yield node.entry
+            remaining -= 1
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __iter__(self):
+        return self._iter_range(0, len(self))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return list(self._iter_range(start, stop)) if start < stop else []
+        return self._node_at(index).entry
+
+    def __setitem__(self, index: int, entry):
+        self._node_at(index).entry = entry
+
+    def append(self, entry):
+        self._root = self._merge(self._root, _QueueNode(entry, random.random()))
+
+    def extend(self, entries):
+        self._root = self._merge(self._root, self._build(list(entries)))
+
+    def insert(self, index: int, entry):
+        index = max(0, min(index, len(self)))
+        left, right = self._split(self._root, index)
+        self._root = self._merge(
+            self._merge(left, _QueueNode(entry, random.random())), right
+        )
+
+    def pop(self, index: int = -1):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pop index out of range")
+        left, rest = self._split(self._root, index)
+        node, right = self._split(rest, 1)
+        self._root = self._merge(left, right)
+        return node.entry
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, index: int, new_index: int):
+        self.insert(new_index, self.pop(index))
+
+    def delete(self, start: int, stop: int):
+        # removes and returns entries [start, stop), the tree surgery itself is O(log n)
+        left, rest = self._split(self._root, start)
+        removed, right = self._split(rest, max(0, stop - start))
+        self._root = self._merge(left, right)
+        return list(TrackQueue._from_root(removed))
+
+    @staticmethod
+    def _from_root(root):
+        queue = TrackQueue()
+        queue._root = root
+        return queue
+
+    def shuffle(self, start: int = 0, seed: int = None):
+        # the same seed shuffles the same entries into the same order
+        left, rest = self._split(self._root, start)
+        entries = list(TrackQueue._from_root(rest))
+        random.Random(seed).shuffle(entries)
+        self._root = self._merge(left, self._build(entries))
+
+
+# download priorities, lower goes first
+PRIORITY_PLAYBACK = 0  # needed for the track that plays next
+PRIORITY_USER = 1  # somebody just queued it
+PRIORITY_PREFETCH = 2  # further ahead in the queue
+PRIORITY_NAMES = {
+    PRIORITY_PLAYBACK: "playback",
+    PRIORITY_USER: "user",
+    PRIORITY_PREFETCH: "prefetch",
+}
+
+
+class _WaitingDownload:
+    __slots__ = ("ready", "priority", "guild_id", "key", "enqueued_at")
+
+    def __init__(self, priority: int, guild_id, key):
+        self.ready = asyncio.get_running_loop().create_future()
+        self.priority = priority
+        self.guild_id = guild_id
+        self.key = key
+        self.enqueued_at = time.monotonic()
+
+
+class DownloadScheduler:
+    # caps how many downloads run at once across all guilds
+    # waiting downloads start by priority, and round-robin between guilds within a priority
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        # {priority: {guild_id: deque of _WaitingDownload}}, guilds in round-robin order
+        self._waiting = {
+            priority: collections.OrderedDict() for priority in PRIORITY_NAMES
+        }
+        self._keys = {}  # {key: _WaitingDownload} so a waiting download can be promoted
+        self._waits = {
+            priority: collections.deque(maxlen=200) for priority in PRIORITY_NAMES
+        }
+
+    async def run(self, guild_id, priority: int, job, key=None):
+        # awaits job() once a slot is free
+        if self.running < self.concurrency and not self.depth():
+            self.running += 1
+            self._waits[priority].append(0.0)
+        else:
+            waiter = _WaitingDownload(priority, guild_id, key)
+            self._push(waiter)
+            try:
+                await waiter.ready
+            except asyncio.CancelledError:
+                if waiter.ready.cancelled():
+                    self._remove(waiter)
+                else:  # the slot was handed over just before we got cancelled
+                    self._finish()
+                raise
+        try:
+            return await job()
+        finally:
+            self._finish()
+
+    def promote(self, key, priority: int):
+        # moves a waiting download up when something more urgent needs it
+        waiter = self._keys.get(key)
+        if waiter is None or priority >= waiter.priority:
+            return
+        self._remove(waiter)
+        waiter.priority = priority
+        self._push(waiter)
+
+    def _push(self, waiter: _WaitingDownload):
+        guilds = self._waiting[waiter.priority]
+        guilds.setdefault(waiter.guild_id, collections.deque()).append(waiter)
+        if waiter.key is not None:
+            self._keys[waiter.key] = waiter
+
+    def _remove(self, waiter: _WaitingDownload):
+        guilds = self._waiting[waiter.priority]
+        waiting = guilds.get(waiter.guild_id)
+        if waiting is not None and waiter in waiting:
+            waiting.remove(waiter)
+            if not waiting:
+                del guilds[waiter.guild_id]
+        if self._keys.get(waiter.key) is waiter:
+            del self._keys[waiter.key]
+
+    def _finish(self):
+        self.running -= 1
+        while self.running < self.concurrency:
+            waiter = self._next()
+            if waiter is None:
+                return
+            self.running += 1
+            waiter.ready.set_result(None)
+
+    def _next(self):
+        for priority, guilds in self._waiting.items():
+            if not guilds:
+                continue
+            guild_id, waiting = next(iter(guilds.items()))
+            waiter = waiting.popleft()
+            # this guild goes to the back of the line for its next download
+            del guilds[guild_id]
+            if waiting:
+                guilds[guild_id] = waiting
+            if self._keys.get(waiter.key) is waiter:
+                del self._keys[waiter.key]
+            self._waits[priority].append(time.monotonic() - waiter.enqueued_at)
+            return waiter
+        return None
+
+    def depth(self, priority: int = None) -> int:
+        priorities = self._waiting if priority is None else (priority,)
+        return sum(len(q) for p in priorities for q in self._waiting[p].values())
+
+    def stats(self):
+        return {
+            PRIORITY_NAMES[priority]: {
+                "waiting": self.depth(priority),
+                "average_wait": sum(waits) / len(waits) if waits else 0.0,
+                "max_wait": max(waits, default=0.0),
+            }
+            for priority, waits in self._waits.items()
+        }
+
+
+download_scheduler = DownloadScheduler(DOWNLOAD_CONCURRENCY)
+
+
+class Histogram:
+    # a prometheus histogram, safe to observe from any thread
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, help_text: str, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)  # per bucket, not cumulative
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if index < len(self._counts):
+                self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def render(self):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+extract_seconds = Histogram(
+    "youtubebot_extract_seconds", "Time yt_dlp spent extracting metadata."
+)
+download_seconds = Histogram(
+    "youtubebot_download_seconds", "Time yt_dlp spent downloading audio."
+)
+ffmpeg_start_seconds = Histogram(
+    "youtubebot_ffmpeg_start_seconds",
+    "Time to spawn ffmpeg for a track and read its first packets.",
+)
+first_audio_seconds = Histogram(
+    "youtubebot_time_to_first_audio_seconds",
+    "Time from a play command to the first audio frame, when nothing was playing.",
+)
+track_gap_seconds = Histogram(
+    "youtubebot_track_gap_seconds",
+    "Silence between the end of a track and the start of the next one.",
+)
+loop_lag_seconds = Histogram(
+    "youtubebot_event_loop_lag_seconds", "How late the event loop ran a timer."
+)
+normalize_seconds = Histogram(
+    "youtubebot_normalize_seconds",
+    "Time spent measuring a file's loudness and writing the gain into it.",
+)
+
+
+class LoopWatchdog:
+    # measures how late the event loop gets around to a timer, all the time
+    # when it's stuck for longer than the threshold, a thread grabs the stack of whatever is blocking it
+    INTERVAL = 0.05  # seconds between heartbeats
+
+    def __init__(self, threshold: float, window: int = 6000):
+        self.threshold = threshold
+        self.lags = collections.deque(maxlen=window)  # 5 minutes of heartbeats
+        self.stalls = collections.deque(
+            maxlen=20
+        )  # (time, seconds blocked, stack or None)
+        self._beat = None  # perf_counter time of the last heartbeat
+        self._loop_thread = None
+        self._stack = None  # of the loop thread, taken while it was stuck
+        self._started = False
+
+    def start(self):
+        # on the event loop
+        if self._started:
+            return
+        self._started = True
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        bot.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.perf_counter() + self.INTERVAL
+            await asyncio.sleep(self.INTERVAL)
+            self._beat = now = time.perf_counter()
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            loop_lag_seconds.observe(lag)
+            stack, self._stack = self._stack, None
+            if lag >= self.threshold:
+                self.stalls.append((time.time(), lag, stack))
+                print(
+                    f"event loop blocked for {lag * 1000:.0f} ms"
+                    + (f", it was stuck in:\n{stack}" if stack else "")
+                )
+
+    def _watch(self):
+        # cheap while the loop is fine, a timestamp comparison a few times per threshold
+        while True:
+            time.sleep(self.threshold / 2)
+            overdue = time.perf_counter() - self._beat - self.INTERVAL
+            if overdue > self.threshold and self._stack is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._stack = "".join(traceback.format_stack(frame))
+
+    def percentiles(self):
+        # -> {"p50": seconds, "p95": ..., "p99": ..., "max": ...} of the recent lags, or None
+        lags = sorted(self.lags)
+        if not lags:
+            return None
+        return {
+            **{
+                f"p{p}": lags[min(len(lags) - 1, len(lags) * p // 100)]
+                for p in (50, 95, 99)
+            },
+            "max": lags[-1],
+        }
+
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_THRESHOLD)
+
+
+class PartialDownload:
+    # a download that playback can start on before it's finished, yt_dlp writes it to a .part file first
+    # and renames that when it's done, which doesn't bother a reader that already has the file open
+    def __init__(self, info, download: asyncio.Future):
+        self.path = audio_cache.path_for(info, YDL_FORMAT) + ".part"
+        self.finished = threading.Event()  # set when the download succeeded or failed
+        self.track = None  # the downloaded Track, it holds the cache reference
+        self._released = False
+        self._download = download
+        download.add_done_callback(self._on_done)
+
+    def _on_done(self, download: asyncio.Future):
+        if download.cancelled():
+            pass
+        elif download.exception() is not None:
+            # playback just ends where the download stopped
+            print(f"failed to download {self.path}: {download.exception()}")
+        else:
+            path, info = download.result()
+            audio_cache.add(path, info)
+            self.track = Track.from_info(info, path=path)
+            if self._released:  # dropped from the queue before it finished
+                release_tracks([self.track])
+        self.finished.set()
+
+    def release(self):
+        if self.track is not None:
+            release_tracks([self.track])
+        else:
+            self._released = True
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0  # still waiting for a download slot
+
+    async def buffered(self, size: int):
+        # until there is enough to start playing or the download is over
+        while not self.finished.is_set() and self.size() < size:
+            # _on_done was added first, so it has run by the time this wakes up
+            await asyncio.wait([self._download], timeout=0.1)
+
+    def open(self):
+        # blocking, for ffmpeg's input thread
+        for path in (self.path, self.path[: -len(".part")]):
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                pass  # renamed, then removed by the postprocessor
+        self.finished.wait()
+        if self.track is not None:
+            return open(self.track.path, "rb")
+        return io.BytesIO()
+
+
+class GrowingFile:
+    # reads a file that's still being downloaded, waiting at its end until more arrives or the download is over
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, download: PartialDownload, video_id: str):
+        self.download = download
+        self.video_id = video_id
+        self.stalled = 0.0  # seconds spent waiting for the download
+        self._file = None
+        self._closed = threading.Event()
+
+    def read(self, size: int = -1) -> bytes:
+        if self._file is None:
+            self._file = self.download.open()
+        while not self._closed.is_set():
+            finished = self.download.finished.is_set()
+            data = self._file.read(size)
+            if data or finished:
+                return data
+            started = time.perf_counter()
+            self._closed.wait(self.POLL_INTERVAL)
+            self.stalled += time.perf_counter() - started
+        return b""
+
+    def close(self):
+        # from any thread, the reading thread closes the file on its way out
+        self._closed.set()
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+        if self.stalled:
+            print(
+                f"playback of {self.video_id} caught up with its download for {self.stalled:.1f}s"
+            )
+
+
+class GrowingFileAudio(nextcord.FFmpegOpusAudio):
+    # nextcord kills ffmpeg as soon as piped input runs out, which cuts off what ffmpeg still has buffered,
+    # so this closes ffmpeg's stdin instead and lets it finish the track
+    def __init__(self, source: GrowingFile, **kwargs):
+        self._input = source
+        self._stdin_lock = threading.Lock()
+        super().__init__(source, pipe=True, **kwargs)
+
+    def _pipe_writer(self, source: GrowingFile):
+        try:
+            while True:
+                data = source.read(64 * 1024)
+                if not data:
+                    break
+                self._stdin.write(data)
+            with self._stdin_lock:
+                if self._process:
+                    # Popen.communicate() in cleanup would flush it otherwise
+                    self._process.stdin = None
+                    self._stdin.close()
+        except Exception:
+            pass  # ffmpeg is gone, e.g. the track was skipped
+        finally:
+            source.release()
+
+    def cleanup(self):
+        self._input.close()
+        with self._stdin_lock:
+            super().cleanup()
+
+
+class PlaybackSource(nextcord.AudioSource):
+    # the ffmpeg source of a track, which can be started and buffered before it's needed
+    # so switching tracks doesn't wait for ffmpeg to spawn and probe the file
+    PACKET_LENGTH = 0.02  # seconds of audio per opus packet
+    WARM_PACKETS = 25
+    PROGRESS_PACKETS = 500  # the position goes to the journal every 10 seconds
+
+    def __init__(self, player, track: Track, start: float = 0.0):
+        self.player = player
+        self.track = track
+        self.start = start  # seconds into the track ffmpeg starts at
+        self.frames = 0
+        self._source = None
+        self._buffered = collections.deque()
+        self._lock = threading.Lock()
+        self._warm = False
+        self._copied = False
+        self._near_end_reported = False
+        self.requested_at = (
+            None  # perf_counter time of the play command that started this
+        )
+        self.replaces = None  # the source a seek swapped this one in for
+
+    def warm(self):
+        # blocking, spawns ffmpeg and reads the first packets
+        with self._lock:
+            if self._warm:
+                return
+            started = time.perf_counter()
+            # a gain applied while playing means transcoding
+            self._copied = (
+                self.track.codec == "opus" and playback_gain(self.track) is None
+            )
+            self._source = create_audio_source(self.track, self.start)
+            for _ in range(self.WARM_PACKETS):
+                packet = self._source.read()
+                if not packet:
+                    break
+                self._buffered.append(packet)
+            self._warm = True
+            ffmpeg_start_seconds.observe(time.perf_counter() - started)
+
+    def read(self) -> bytes:
+        if self.replaces is not None:
+            # the audio thread has moved on to this one, so it's done reading the one it replaces
+            self._cleanup_replaced()
+        if not self._warm:
+            self.warm()
+        packet = self._buffered.popleft() if self._buffered else self._source.read()
+        now = time.perf_counter()
+        if not packet:
+            self.player.track_ended_at = now
+            return packet
+        if self.frames == 0 and self.player.track_ended_at is not None:
+            transition_gaps.append(now - self.player.track_ended_at)
+            track_gap_seconds.observe(now - self.player.track_ended_at)
+            self.player.track_ended_at = None
+        if self.frames == 0 and self.requested_at is not None:
+            first_audio_seconds.observe(now - self.requested_at)
+        self.frames += 1
+        if self.frames % self.PROGRESS_PACKETS == 0:
+            self.player.post("progress", self)
+
+        remaining = (self.track.duration or 0) - self.position
+        if (
+            not self._near_end_reported
+            and self.track.duration
+            and remaining <= PREWARM_SECONDS
+        ):
+            self._near_end_reported = True
+            self.player.post("prewarm", self.track)
+        return packet
+
+    @property
+    def position(self) -> float:
+        # seconds into the track, counted from the packets that went out
+        return self.start + self.frames * self.PACKET_LENGTH
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        with self._lock:
+            if self._source is not None:
+                cpu = ffmpeg_cpu_seconds(self._source)
+                if cpu is not None and self.frames:
+                    copied = self._copied
+                    audio = self.frames * self.PACKET_LENGTH
+                    ffmpeg_cpu_usage.append((copied, cpu, audio))
+                    print(
+                        f"ffmpeg used {cpu:.2f}s of cpu for {audio:.0f}s of {self.track.id} "
+                        f"({'copied' if copied else 'transcoded'})"
+                    )
+                self._source.cleanup()
+                self._source = None
+            self._buffered.clear()
+            self._warm = True  # nothing left to read
+        self._cleanup_replaced()  # stopped before the audio thread got to this one
+
+    def _cleanup_replaced(self):
+        replaced, self.replaces = self.replaces, None
+        if replaced is not None:
+            replaced.cleanup()
+
+
+class GuildPlayer:
+    # drives playback in one guild, it owns the guild's queue and loop mode
+    # everything that touches them runs as a message in this actor's task, one at a time, on the event loop
+    # the audio thread only ever posts events here, it never touches the queue or waits on the loop
+    def __init__(
+        self, server_id, connection, journaled: bool = True, loop_mode: str = "off"
+    ):
+        self.server_id = server_id
+        self.connection = connection
+        self.journaled = journaled  # whether a restart brings this player back
+        self.queue = TrackQueue()  # the playing track is queue[0]
+        self.loop_mode = loop_mode
+        self.source = None  # PlaybackSource of the track that's playing
+        self.prewarmed = None  # PlaybackSource of the track that plays next
+        self.track_ended_at = None  # perf_counter time the last track ran out
+        self._playing = False
+        self._skipped = False  # whether the playing track was stopped by a skip
+        # (requested_at, start) for the head, while the prefetch resolves it
+        self._waiting = None
+        self._stream_failed = set()  # ids of tracks to download instead of streaming
+        self._position_saved = False  # whether the journal has the playing track past 0
+        self._prefetch_task = None
+        self._inbox = asyncio.Queue()
+        self._task = bot.loop.create_task(self._run())
+        self._record("start", connection.channel.id if journaled else None)
+        if loop_mode != "off":
+            self._record("loop", loop_mode)
+
+    def _record(self, op: str, *args):
+        # every change to the queue or loop mode goes to the journal right after it's made
+        if self.journaled:
+            journal.record(self.server_id, op, *args)
+
+    @property
+    def position(self) -> float:
+        return self.source.position if self.source is not None else 0.0
+
+    def post(self, message: str, *args):
+        # fire and forget, safe to call from any thread
+        bot.loop.call_soon_threadsafe(self._inbox.put_nowait, (message, args, None))
+
+    async def call(self, message: str, *args):
+        # from the event loop, waits for the message to be handled and returns the result
+        result = bot.loop.create_future()
+        self._inbox.put_nowait((message, args, result))
+        return await result
+
+    def stop(self):
+        # on the event loop, for when the bot left the voice channel
+        self._task.cancel()
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        while not self._inbox.empty():
+            # a track the prefetch resolved that never made it into the queue
+            message, args, _ = self._inbox.get_nowait()
+            if message == "resolved" and args[1] is not None:
+                release_tracks([args[1]])
+        self._discard_prewarmed()
+        release_tracks(self.queue.delete(0, len(self.queue)))
+        self._record("end")
+
+    async def _run(self):
+        while True:
+            message, args, result = await self._inbox.get()
+            try:
+                value = await getattr(self, f"_on_{message}")(*args)
+            except Exception as err:
+                if result is None:
+                    print(f"player of {self.server_id} failed on {message}: {err!r}")
+                elif not result.done():
+                    result.set_exception(err)
+            else:
+                if result is not None and not result.done():
+                    result.set_result(value)
+
+    async def _on_enqueue(self, tracks, requested_at: float = None, start: float = 0.0):
+        for chunk in range(0, len(tracks), Journal.ADD_CHUNK):
+            if chunk > 0:
+                await asyncio.sleep(0)  # lets the rest of the bot in between
+            added = tracks[chunk : chunk + Journal.ADD_CHUNK]
+            self.queue.extend(added)
+            self._record("add", Journal.encode(added))
+        if not self._playing:
+            await self._play_next(requested_at, start)
+        self._schedule_prefetch()
+
+    async def _on_track_end(self, error):
+        if error is not None:
+            print(error)
+        self._playing = False
+        source, self.source = self.source, None
+        if source is not None:
+            source.cleanup()  # a seek may have swapped it in after the track had already ended
+        skipped, self._skipped = self._skipped, False
+
+        head = self.queue[0]
+        if (
+            head.stream_url is not None
+            and not skipped
+            and (error is not None or (source is not None and source.frames == 0))
+        ):
+            # ffmpeg got nothing out of the stream url (refused, expired or throttled), so it's downloaded instead
+            print(f"streaming {head.id} failed, downloading it instead")
+            self._stream_failed.add(head.id)
+            self.queue[0] = head.unresolved()
+            await self._play_next()
+            return
+
+        track = self.queue.popleft()
+        if self.loop_mode == "single":
+            self.queue.insert(
+                0, track
+            )  # as far as the journal is concerned nothing changed
+        elif self.loop_mode == "all":
+            if len(self.queue) >= PREFETCH_WINDOW:
+                # only the prefetch window holds on to files, this one gets resolved again when it comes around
+                release_tracks([track])
+                track = track.unresolved()
+            self.queue.append(track)
+            # one record, a snapshot between two of them would have the rotation in it already
+            self._record("move", 0, len(self.queue) - 1)
+        else:
+            release_tracks([track])
+            self._record("del", 0, 1)
+
+        await self._play_next()
+        if len(self.queue) == 0:
+            # No more tracks in the queue
+            await safe_disconnect(self.connection)
+            return
+        self._schedule_prefetch()
+
+    async def _play_next(self, requested_at: float = None, start: float = 0.0):
+        # starts the head of the queue at start seconds
+        # a head that has to be resolved first is left to the prefetch, which reports back through the inbox,
+        # so the player keeps taking commands while it downloads
+        if len(self.queue) == 0:
+            self._waiting = None
+            return
+        head = self.queue[0]
+        track = self._playable(head)
+        if track is None:
+            if head.resolved:  # a stream url about to expire, or a download that failed
+                release_tracks([head])
+                self.queue[0] = head.unresolved()
+            self._waiting = (requested_at, start)
+            self._schedule_prefetch()
+            return
+        self._waiting = None
+        self.queue[0] = track
+        source = self.prewarmed
+        self.prewarmed = None
+        if (
+            source is None
+            or (source.track is not track and source.track is not head)
+            or source.start != start
+        ):
+            # nothing prepared, or the queue changed since
+            if source is not None:
+                source.cleanup()
+            source = PlaybackSource(self, track, start)
+        source.track = track  # its download may have finished since it was prewarmed
+        source.requested_at = requested_at
+        self.connection.play(
+            source, after=lambda error=None: self.post("track_end", error)
+        )
+        self.source = source
+        self._playing = True
+        if start or self._position_saved:
+            self._record("pos", track.id, start)
+            self._position_saved = bool(start)
+
+    async def _play_waiting(self):
+        # once the head the player was waiting for is resolved or gone
+        if self._playing or self._waiting is None:
+            return
+        if len(self.queue) == 0:
+            self._waiting = None
+            await safe_disconnect(self.connection)  # none of it could be played
+            return
+        await self._play_next(*self._waiting)
+
+    async def _on_progress(self, source: PlaybackSource):
+        if source is self.source:
+            self._record("pos", source.track.id, round(source.position, 1))
+            self._position_saved = True
+
+    async def _on_seek(self, position: float):
+        # starts another ffmpeg on the playing track at the position and swaps it in, from the file on disk
+        # it takes as long as starting a track does, -> the position, or None if there's nothing to seek in
+        playing = self.source
+        if playing is None or not self._playing:
+            return None
+        track = playing.track
+        position = max(0.0, position)
+        if track.duration and position >= track.duration:
+            return None
+        source = PlaybackSource(self, track, position)
+        await bot.loop.run_in_executor(None, source.warm)
+        if not (self.connection.is_playing() or self.connection.is_paused()):
+            source.cleanup()  # skipped or ran out meanwhile, the track_end is on its way
+            return None
+        self._discard_prewarmed()  # the new source asks for it again when it gets near the end
+        paused = self.connection.is_paused()
+        # the audio thread may be in the middle of reading the old source, it cleans it up when it gets to this one
+        source.replaces = playing
+        self.connection.source = source
+        if paused:  # swapping the source resumes playback
+            self.connection.pause()
+        self.source = source
+        self._record("pos", track.id, round(position, 1))
+        self._position_saved = True
+        return position
+
+    @staticmethod
+    def _playable(track: Track):
+        # the track to play, or None if it has to be resolved (again) first
+        if track.download is not None:
+            if not track.download.finished.is_set():
+                return track  # plays what's there and follows the rest of the download
+            return track.download.track  # takes over the cache reference
+        if track.path is not None or (
+            track.resolved and not stream_expires_soon(track)
+        ):
+            return track
+        return None
+
+    async def _on_prewarm(self, playing: Track):
+        # posted shortly before a track ends, gets ffmpeg going for the one after it
+        if len(self.queue) == 0 or self.queue[0] is not playing:
+            return
+        if self.loop_mode == "single" or (
+            self.loop_mode == "all" and len(self.queue) == 1
+        ):
+            upcoming = self.queue[0]  # the same track again
+        elif len(self.queue) > 1:
+            upcoming = self.queue[1]
+        else:
+            return
+        if not upcoming.resolved or stream_expires_soon(upcoming):
+            return  # it has to be resolved first anyway
+        self._discard_prewarmed()
+        self.prewarmed = PlaybackSource(self, upcoming)
+        bot.loop.run_in_executor(None, self.prewarmed.warm)
+
+    def _discard_prewarmed(self):
+        if self.prewarmed is not None:
+            self.prewarmed.cleanup()
+            self.prewarmed = None
+
+    async def _on_skip(self, n_skips: int):
+        if not self._playing:
+            # the head is still being resolved, so there's no track_end to drop it
+            release_tracks(self.queue.delete(0, n_skips))
+            self._record("del", 0, n_skips)
+            await self._play_waiting()
+            return
+        self._skipped = True
+        release_tracks(self.queue.delete(1, n_skips))
+        self._record("del", 1, n_skips)
+        self.connection.stop()  # the track_end event takes it from here
+
+    async def _on_remove(self, position: int):
+        if position >= len(self.queue):
+            return None
+        removed = self.queue.pop(position)
+        release_tracks([removed])
+        self._record("del", position, position + 1)
+        self._schedule_prefetch()
+        return removed
+
+    async def _on_move(self, index: int, new_index: int):
+        if max(index, new_index) >= len(self.queue):
+            return False
+        self.queue.move(index, new_index)
+        self._record("move", index, new_index)
+        # the moved track, or the one it pushed out of the window
+        self._unresolve_beyond_window([new_index, PREFETCH_WINDOW + 1])
+        self._schedule_prefetch()
+        await self._play_waiting()  # the new head may be ready to play
+        return True
+
+    async def _on_shuffle(self):
+        # the window's resolved tracks are shuffled as unresolved stand-ins, the ones that stay in it get their files back
+        window = range(1, min(PREFETCH_WINDOW + 1, len(self.queue)))
+        resolved = {}
+        for index in window:
+            track = self.queue[index]
+            if track.resolved:
+                stand_in = self.queue[index] = track.unresolved()
+                resolved[id(stand_in)] = track
+        # the journal gets the seed, replaying it shuffles the same queue the same way
+        seed = random.getrandbits(64)
+        self.queue.shuffle(1, seed)  # everything except the currently playing song
+        self._record("shuffle", 1, seed)
+        for index in window:
+            track = resolved.pop(id(self.queue[index]), None)
+            if track is not None:
+                self.queue[index] = track
+        release_tracks(resolved.values())  # shuffled out of the window
+        self._schedule_prefetch()
+
+    def _unresolve_beyond_window(self, indices):
+        # only the prefetch window holds on to files, a track reordered out of it is resolved again when it comes around
+        for index in indices:
+            if index <= PREFETCH_WINDOW or index >= len(self.queue):
+                continue
+            track = self.queue[index]
+            if not track.resolved or (
+                self.source is not None and track is self.source.track
+            ):
+                continue  # the playing track keeps its file until it ends
+            release_tracks([track])
+            self.queue[index] = track.unresolved()
+
+    async def _on_clear(self):
+        cleared = self.queue.delete(1, len(self.queue))
+        release_tracks(cleared)
+        self._record("del", 1, 1 + len(cleared))
+
+    async def _on_set_loop(self, mode: str):
+        self.loop_mode = mode
+        self._record("loop", mode)
+
+    async def _on_resolved(self, pending: Track, resolved):
+        # the queue may have changed while resolving, if the entry left the window it's resolved again later
+        window = self.queue[: PREFETCH_WINDOW + 1]
+        index = next((i for i, track in enumerate(window) if track is pending), None)
+        if index is None:
+            release_tracks([resolved] if resolved is not None else [])
+        elif resolved is None:
+            self.queue.pop(index)
+            self._record("del", index, index + 1)
+        else:
+            self.queue[index] = resolved
+        await self._play_waiting()
+
+    def _schedule_prefetch(self):
+        if self._prefetch_task is None or self._prefetch_task.done():
+            self._prefetch_task = bot.loop.create_task(self._prefetch())
+
+    async def _prefetch(self):
+        # resolves the unresolved tracks among the next PREFETCH_WINDOW ones, one at a time
+        # reading the queue is fine here, changing it goes through the inbox like everything else
+        while True:
+            pending = next(
+                (
+                    (index, track)
+                    for index, track in enumerate(self.queue[: PREFETCH_WINDOW + 1])
+                    if not track.resolved
+                ),
+                None,
+            )
+            if pending is None:
+                return
+            index, track = pending
+            # the current and the next track are what playback is waiting on, the rest can wait
+            priority = PRIORITY_PLAYBACK if index <= 1 else PRIORITY_PREFETCH
+            if track.id in self._stream_failed:
+                self._stream_failed.discard(track.id)
+                mode = "download"
+            else:
+                mode = playback_modes.get(self.server_id, PLAYBACK_MODE)
+            try:
+                resolved = await resolve_track(
+                    track.link,
+                    mode,
+                    guild_id=self.server_id,
+                    priority=priority,
+                )
+            except yt_dlp.utils.DownloadError as err:
+                print(f"failed to resolve {track.id}: {err}")
+                resolved = None
+            await self.call("resolved", track, resolved)
+
+
+async def get_player(server_id, voice_state) -> GuildPlayer:
+    # joins the author's voice channel the first time something gets queued
+    if server_id in players:
+        return players[server_id]
+    try:
+        connection = await voice_state.channel.connect()
+    except nextcord.ClientException:
+        connection = get_voice_client_from_channel_id(voice_state.channel.id)
+    if connection is not None and (connection.is_playing() or connection.is_paused()):
+        # tuned in to a station since the command checked, the queue takes over
+        connection.stop()
+        tuned_in.pop(server_id, None)
+    if server_id not in players:  # another command may have got here first
+        players[server_id] = GuildPlayer(
+            server_id, connection, loop_mode=loop_modes.pop(server_id, "off")
+        )
+    return players[server_id]
+
+
+def stop_player(server_id):
+    player = players.pop(server_id, None)
+    if player is not None:
+        player.stop()
+        loop_modes[server_id] = player.loop_mode  # kept for the next queue, like before
+
+
+class Broadcast:
+    # stands in for a voice client so a GuildPlayer can drive a radio station
+    # each track is read from ffmpeg once into a ring buffer, every listening guild reads that at its own position
+    BUFFER_FRAMES = 250  # 5 seconds, a listener further behind skips ahead
+    SILENCE = (
+        b"\xf8\xff\xfe"  # an opus frame of silence, for while the next track starts
+    )
+
+    def __init__(self):
+        self.listeners = set()
+        self._source = None
+        self._after = None
+        self._frames = collections.deque(maxlen=self.BUFFER_FRAMES)
+        self._end = (
+            0  # number of frames ever read, the newest one in the buffer is _end - 1
+        )
+        self._lock = threading.Lock()
+
+    def play(self, source, after=None):
+        with self._lock:
+            self._source, self._after = source, after
+
+    def is_playing(self) -> bool:
+        return self._source is not None
+
+    def stop(self):
+        with self._lock:
+            source, after = self._source, self._after
+            self._source = self._after = None
+        if source is not None:
+            source.cleanup()
+            if after is not None:
+                after(None)
+
+    async def disconnect(self):
+        # nothing left on the station, the listeners stay tuned in to silence until something is added
+        with self._lock:
+            source, self._source, self._after = self._source, None, None
+        if source is not None:
+            source.cleanup()
+
+    def subscribe(self, listener) -> int:
+        # -> the position to start reading at, new listeners join live
+        with self._lock:
+            self.listeners.add(listener)
+            return self._end
+
+    def unsubscribe(self, listener) -> int:
+        # -> how many listeners are left
+        with self._lock:
+            self.listeners.discard(listener)
+            return len(self.listeners)
+
+    def frame(self, position: int):
+        # on a listener's audio thread, -> (next position, opus frame)
+        with self._lock:
+            if position < self._end:
+                return self._buffered(position)
+            source = self._source
+            if source is None:
+                return position, self.SILENCE
+        # a new track spawns ffmpeg here, outside the lock so the listeners still reading the buffer aren't held up
+        source.warm()
+        with self._lock:
+            if position < self._end:  # another listener got the next frame meanwhile
+                return self._buffered(position)
+            if self._source is not source:
+                return position, self.SILENCE
+            # this listener is the furthest ahead, so it's the one that reads the next frame from ffmpeg
+            packet = self._source.read()
+            if packet:
+                self._frames.append(packet)
+                self._end += 1
+                return self._end, packet
+            finished = self._source, self._after
+            self._source = self._after = None
+        source, after = finished
+        source.cleanup()
+        if after is not None:
+            after(None)
+        return position, self.SILENCE
+
+    def _buffered(self, position: int):
+        # with the lock held, a listener that fell behind the buffer skips ahead to its oldest frame
+        oldest = self._end - len(self._frames)
+        position = max(position, oldest)
+        return position + 1, self._frames[position - oldest]
+
+
+class StationListener(nextcord.AudioSource):
+    # what a voice client tuned in to a station plays
+    def __init__(self, name: str, broadcast: Broadcast):
+        self.name = name
+        self.broadcast = broadcast
+        self._position = broadcast.subscribe(self)
+        self._closed = False
+
+    def read(self) -> bytes:
+        self._position, packet = self.broadcast.frame(self._position)
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.broadcast.unsubscribe(self) == 0:
+            bot.loop.call_soon_threadsafe(close_station, self.name)
+
+
+def get_station(name: str) -> GuildPlayer:
+    station = stations.get(name)
+    if station is None:
+        station = stations[name] = GuildPlayer(
+            f"radio:{name}", Broadcast(), journaled=False
+        )
+        station.loop_mode = "all"  # a station keeps going round its playlist
+    return station
+
+
+def close_station(name: str):
+    # once nobody is listening anymore
+    station = stations.get(name)
+    if station is None or station.connection.listeners:
+        return
+    del stations[name]
+    station.stop()
+    bot.loop.create_task(station.connection.disconnect())
+
+
+class TokenBucket:
+    # allows `capacity` actions at once, refilled at `rate` per second
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._refilled_at = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._refilled_at) * self.rate
+            )
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChannelStatus:
+    # progress lines for one text channel, shown by editing a single message in place
+    # a burst of lines becomes one edit per FLUSH_INTERVAL, and every send or edit waits for the
+    # channel's rate limit here instead of running into discord's
+    FLUSH_INTERVAL = 1.0
+    MAX_LINES = 10
+    FRESH_AFTER = 30.0  # seconds of quiet after which a new message is started instead of editing the old one
+
+    def __init__(self, channel):
+        self.channel = channel
+        # discord allows 5 messages per 5 seconds per channel, one is left for direct replies
+        self.bucket = TokenBucket(4, 0.8)
+        self._lines = collections.deque(maxlen=self.MAX_LINES)
+        self._message = None
+        self._posted_at = 0.0
+        self._pending = False
+        self._flusher = None
+
+    def post(self, line: str):
+        now = time.monotonic()
+        if now - self._posted_at > self.FRESH_AFTER:
+            self._lines.clear()
+            self._message = None
+        self._posted_at = now
+        self._lines.append(line)
+        self._pending = True
+        if self._flusher is None or self._flusher.done():
+            self._flusher = bot.loop.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending:
+            await self.bucket.take()
+            self._pending = False
+            content = "\n".join(self._lines)
+            try:
+                if self._message is None:
+                    self._message = await self.channel.send(content)
+                else:
+                    await self._message.edit(content=content)
+            except nextcord.HTTPException as err:
+                print(f"failed to update the status in {self.channel.id}: {err}")
+                self._message = None
+            # whatever gets posted meanwhile goes out together in the next edit
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+
+
+def status_for(ctx: commands.Context) -> ChannelStatus:
+    status = channel_statuses.get(ctx.channel.id)
+    if status is None:
+        status = channel_statuses[ctx.channel.id] = ChannelStatus(ctx.channel)
+    return status
 
 
 class QueueMenu(menus.Menu):
@@ -87,7 +2424,9 @@ class QueueMenu(menus.Menu):
             if isinstance(val, str)
             else "**%2d:** %s\n" % (val[0] + start_index, val[1])
         )
-        return "".join(map(title_str, enumerate([i[1]["title"] for i in queue_chunk])))
+        return "".join(
+            map(title_str, enumerate([track.title for track in queue_chunk]))
+        )
 
     @menus.button("\u23ee")  # First Page
     async def on_first_page(self, payload):
@@ -117,7 +2456,7 @@ class QueueMenu(menus.Menu):
 @bot.command(name="queue", aliases=["q"])
 async def queue(ctx: commands.Context, *args):
     try:
-        queue = queues[ctx.guild.id]
+        queue = players[ctx.guild.id].queue
     except KeyError:
         queue = None
 
@@ -135,11 +2474,12 @@ async def queue(ctx: commands.Context, *args):
 @bot.command(name="skip", aliases=["s"])
 async def skip(ctx: commands.Context, *args):
     try:
-        queue_length = len(queues[ctx.guild.id])
+        queue_length = len(players[ctx.guild.id].queue)
     except KeyError:
         queue_length = 0
     if queue_length <= 0:
         await ctx.send("The bot isn't playing anything")
+        return
     if not await sense_checks(ctx):
         return
 
@@ -161,10 +2501,9 @@ async def skip(ctx: commands.Context, *args):
         n_skips = queue_length
     await ctx.send(message)
 
-    voice_client = get_voice_client_from_channel_id(ctx.author.voice.channel.id)
-    for _ in range(n_skips - 1):
-        queues[ctx.guild.id].pop(0)
-    voice_client.stop()
+    player = players.get(ctx.guild.id)
+    if player is not None:
+        await player.call("skip", n_skips)
 
 
 @bot.command(name="pause", aliases=["pu"])
@@ -191,9 +2530,8 @@ async def unpause(ctx: commands.Context):
 async def exit(ctx: commands.Context):
     voice_client = get_voice_client_from_channel_id(ctx.author.voice.channel.id)
     if voice_client is not None:
-        server_id = ctx.guild.id
-        queues.pop(server_id, None)  # Clear the queue
-        loop_modes[server_id] = "off"  # Set loop mode to "off"
+        stop_player(ctx.guild.id)  # Clear the queue, the loop mode goes with it
+        loop_modes.pop(ctx.guild.id, None)
         await voice_client.disconnect()  # Disconnect from the voice channel
         await ctx.send("Bot has left the voice channel and the queue has been cleared.")
     else:
@@ -202,52 +2540,30 @@ async def exit(ctx: commands.Context):
 
 @bot.command(name="play", aliases=["p"])
 async def play(ctx: commands.Context, *args):
+    requested_at = time.perf_counter()
     voice_state = ctx.author.voice
     if not await sense_checks(ctx, voice_state=voice_state):
         return
+    if not await not_tuned_in(ctx):
+        return
 
     query = " ".join(args)
     parsed_query = urllib.parse.urlparse(query)
 
-    if (
-        parsed_query.scheme != "http"
-        and parsed_query.scheme != "https"
-        and parsed_query.netloc != "www.youtube.com"
-    ):
+    # this is how it's determined if the url is valid (i.e. whether to search or not) under the hood of yt-dlp
+    will_need_search = not parsed_query.scheme
+    if not will_need_search and parsed_query.scheme not in ("http", "https"):
         await ctx.send("Invalid YouTube link.")
         return
-    # this is how it's determined if the url is valid (i.e. whether to search or not) under the hood of yt-dlp
-    will_need_search = not urllib.parse.urlparse(query).scheme
 
     server_id = ctx.guild.id
 
-    # source address as 0.0.0.0 to force ipv4 because ipv6 breaks it for some reason
-    # this is equivalent to --force-ipv4 (line 312 of https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/options.py)
-    await ctx.send(f"Looking for `{query}`...")
-    with yt_dlp.YoutubeDL(
-        {
-            "format": "worstaudio",
-            "source_address": "0.0.0.0",
-            "default_search": "ytsearch",
-            "outtmpl": "%(id)s.%(ext)s",
-            "noplaylist": True,
-            "ignoreerrors": True,
-            "allow_playlist_files": False,
-            # 'progress_hooks': [lambda info, ctx=ctx: video_progress_hook(ctx, info)],
-            # 'match_filter': lambda info, incomplete, will_need_search=will_need_search, ctx=ctx: start_hook(ctx, info, incomplete, will_need_search),
-            "paths": {"home": f"./dl/{server_id}"},
-        }
-    ) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-        except yt_dlp.utils.DownloadError as err:
-            await notify_about_failure(ctx, err)
-            return
+    status = status_for(ctx)
+    status.post(f"Looking for `{query}`...")
 
-        if "entries" in info:
-            info = info["entries"][0]
+    async def announce_download(info):
         # send link if it was a search, otherwise send title as sending link again would clutter chat with previews
-        await ctx.send(
+        status.post(
             "Downloading "
             + (
                 f'https://youtu.be/{info["id"]}'
@@ -255,34 +2571,31 @@ async def play(ctx: commands.Context, *args):
                 else f'`{info["title"]}`'
             )
         )
-        try:
-            ydl.download([query])
-        except yt_dlp.utils.DownloadError as err:
-            await notify_about_failure(ctx, err)
-            return
 
-        path = f'./dl/{server_id}/{info["id"]}.{info["ext"]}'
-        try:
-            queues[server_id].append((path, info))
-        except KeyError:  # first in queue
-            queues[server_id] = [(path, info)]
-            try:
-                connection = await voice_state.channel.connect()
-            except nextcord.ClientException:
-                connection = get_voice_client_from_channel_id(voice_state.channel.id)
-            connection.play(
-                nextcord.FFmpegOpusAudio(path),
-                after=lambda error=None, connection=connection, server_id=server_id: after_track(
-                    error, connection, server_id
-                ),
-            )
+    try:
+        track = await resolve_track(
+            query,
+            playback_modes.get(server_id, PLAYBACK_MODE),
+            announce_download,
+            server_id,
+            PRIORITY_USER,
+        )
+    except yt_dlp.utils.DownloadError as err:
+        await notify_about_failure(ctx, err)
+        return
+
+    player = await get_player(server_id, voice_state)
+    await player.call("enqueue", [track], requested_at)
 
 
 @bot.command(name="playlist", aliases=["pl"])
 async def playlist(ctx: commands.Context, *args):
+    requested_at = time.perf_counter()
     voice_state = ctx.author.voice
     if not await sense_checks(ctx, voice_state=voice_state):
         return
+    if not await not_tuned_in(ctx):
+        return
 
     query = " ".join(args)
     parsed_query = urllib.parse.urlparse(query)
@@ -294,39 +2607,134 @@ async def playlist(ctx: commands.Context, *args):
     ):
         await ctx.send("Invalid YouTube link.")
         return
-    await ctx.send(f"Adding playlist: `{query}`...")
+    status = status_for(ctx)
+    status.post(f"Adding playlist: `{query}`...")
 
     server_id = ctx.guild.id
 
     # Download the playlist information
-    with yt_dlp.YoutubeDL({"extract_flat": "in_playlist", "simulate": True}) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-        except yt_dlp.utils.DownloadError as err:
-            await notify_about_failure(ctx, err)
-            return
+    try:
+        info = await run_ytdl(YDL_PLAYLIST_OPTIONS, "extract", query)
+    except yt_dlp.utils.DownloadError as err:
+        await notify_about_failure(ctx, err)
+        return
 
-        if "entries" not in info:
-            await ctx.send("No playlist found.")
-            return
+    if "entries" not in info:
+        await ctx.send("No playlist found.")
+        return
+
+    playlist_entries = [entry for entry in info["entries"] if entry and entry.get("id")]
+    metadata_cache.remember(playlist_entries)
+    metadata_cache.store_playlist(info)
+    status.post(f"Playlist found: `{len(playlist_entries)}` videos.")
+
+    # Queue every video unresolved, only the ones about to play get downloaded (see prefetch)
+    player = await get_player(server_id, voice_state)
+    await player.call(
+        "enqueue",
+        [
+            Track(entry["id"], entry.get("title"), duration=entry.get("duration"))
+            for entry in playlist_entries
+        ],
+        requested_at,
+    )
+
+    status.post(f"Playlist added to the queue: `{len(playlist_entries)}` videos.")
+
+
+class SlashContext:
+    # the parts of a commands.Context the commands use, so a slash command can run them
+    # replies only go to whoever used the command, the progress messages still go to the channel
+    def __init__(self, interaction: nextcord.Interaction):
+        self.interaction = interaction
+        self.guild = interaction.guild
+        self.channel = interaction.channel
+        self.author = interaction.user
+        self.replied = False
 
-        playlist_entries = info["entries"]
-        playlist_titles = [entry["title"] for entry in playlist_entries]
-        await ctx.send(f"Playlist found: `{len(playlist_entries)}` videos.")
+    async def send(self, *args, **kwargs):
+        self.replied = True
+        return await self.interaction.send(*args, ephemeral=True, **kwargs)
 
-        # Add each video in the playlist to the queue
-        for entry in playlist_entries:
-            video_url = f'https://youtu.be/{entry["id"]}'
-            await ctx.invoke(bot.get_command("play"), video_url)
 
-    await ctx.send(f"Playlist added to the queue: `{len(playlist_entries)}` videos.")
+async def run_as_slash_command(interaction: nextcord.Interaction, command, query: str):
+    # discord wants an answer within 3 seconds, looking something up can take longer
+    await interaction.response.defer(ephemeral=True)
+    ctx = SlashContext(interaction)
+    try:
+        await command.callback(ctx, query)
+    except Exception as err:
+        # otherwise the interaction keeps saying the bot is thinking
+        print(f"/{command.name} {query!r} failed: {err!r}")
+        await ctx.send("Something went wrong, the command could not be run.")
+        return
+    if not ctx.replied:
+        await ctx.send("Added to the queue.")
+
+
+def autocomplete_choices(suggestions, link):
+    # discord takes up to 25 choices with names and values of at most 100 characters
+    choices = {}
+    for entry_id, title in suggestions:
+        name = title if len(title) <= 100 else title[:99] + "…"
+        if name in choices:  # same title, different video
+            name = f"{name[:100 - len(entry_id) - 3]} ({entry_id})"
+        choices[name] = link(entry_id)
+    return choices
+
+
+@bot.slash_command(name="play", description="Plays or queues a video")
+async def play_slash_command(
+    interaction: nextcord.Interaction,
+    query: str = nextcord.SlashOption(
+        description="A link, something to search for, or one of the suggestions",
+        autocomplete=True,
+    ),
+):
+    await run_as_slash_command(interaction, play, query)
+
+
+@play_slash_command.on_autocomplete("query")
+async def suggest_videos(interaction: nextcord.Interaction, query: str):
+    # from memory, choosing a suggestion plays its link so there's no search either
+    await interaction.response.send_autocomplete(
+        autocomplete_choices(
+            metadata_cache.videos.suggest(query),
+            lambda video_id: f"https://youtu.be/{video_id}",
+        )
+    )
+
+
+@bot.slash_command(name="playlist", description="Plays or queues a playlist of videos")
+async def playlist_slash_command(
+    interaction: nextcord.Interaction,
+    link: str = nextcord.SlashOption(
+        description="A link to the playlist, or one of the suggestions",
+        autocomplete=True,
+    ),
+):
+    await run_as_slash_command(interaction, playlist, link)
+
+
+@playlist_slash_command.on_autocomplete("link")
+async def suggest_playlists(interaction: nextcord.Interaction, link: str):
+    await interaction.response.send_autocomplete(
+        autocomplete_choices(
+            metadata_cache.playlists.suggest(link),
+            lambda playlist_id: f"https://www.youtube.com/playlist?list={playlist_id}",
+        )
+    )
 
 
 @bot.command(name="loop", aliases=["l"])
 async def loop(ctx: commands.Context, mode: str = None):
-    server_id = ctx.guild.id
+    player = players.get(ctx.guild.id)
     if mode is None:
-        current_mode = loop_modes.get(server_id, "off")
+        current_mode = (
+            player.loop_mode
+            if player is not None
+            else loop_modes.get(ctx.guild.id, "off")
+        )
         await ctx.send(f"Current loop mode: {current_mode}")
         return
 
@@ -335,14 +2743,116 @@ async def loop(ctx: commands.Context, mode: str = None):
         await ctx.send("Invalid loop mode. Available modes: All, Single, Off")
         return
 
-    loop_modes[server_id] = mode
+    if player is None:
+        loop_modes[ctx.guild.id] = mode  # for whatever gets queued next
+    else:
+        await player.call("set_loop", mode)
     await ctx.send(f"Loop mode set to: {mode.capitalize()}")
 
 
+@bot.command(name="stream", aliases=["st"])
+async def stream(ctx: commands.Context, mode: str = None):
+    server_id = ctx.guild.id
+    if mode is None:
+        current_mode = playback_modes.get(server_id, PLAYBACK_MODE)
+        await ctx.send(f"Current playback mode: {current_mode}")
+        return
+
+    mode = mode.lower()
+    if mode in ["on", "stream"]:
+        mode = "stream"
+    elif mode in ["off", "download"]:
+        mode = "download"
+    else:
+        await ctx.send("Invalid playback mode. Available modes: On, Off")
+        return
+
+    playback_modes[server_id] = mode
+    await ctx.send(f"Playback mode set to: {mode.capitalize()}")
+
+
+@bot.command(name="radio", aliases=["rd"])
+async def radio(ctx: commands.Context, name: str = None, *args):
+    if name is None:
+        if not stations:
+            await ctx.send("No stations are on the air.")
+            return
+        await ctx.send(
+            "\n".join(
+                f"`{station_name}`: "
+                f"{station.queue[0].title if len(station.queue) > 0 else 'nothing'}, "
+                f"`{len(station.connection.listeners)}` guilds listening"
+                for station_name, station in stations.items()
+            )
+        )
+        return
+
+    voice_state = ctx.author.voice
+    if not await sense_checks(ctx, voice_state=voice_state):
+        return
+    if ctx.guild.id in players:
+        await ctx.send("The bot is playing a queue here, use exit before tuning in")
+        return
+
+    name = name.lower()
+    query = " ".join(args)
+    if not query and name not in stations:
+        await ctx.send(f"There's no station `{name}`, give it a link to start it.")
+        return
+    if query and urllib.parse.urlparse(query).scheme not in ("http", "https"):
+        await ctx.send("Invalid YouTube link.")
+        return
+
+    tracks = []
+    if query:
+        status_for(ctx).post(f"Adding `{query}` to `{name}`...")
+        try:
+            tracks = await tracks_for_link(query, f"radio:{name}")
+        except yt_dlp.utils.DownloadError as err:
+            await notify_about_failure(ctx, err)
+            return
+
+    try:
+        voice_client = await voice_state.channel.connect()
+    except nextcord.ClientException:
+        voice_client = get_voice_client_from_channel_id(voice_state.channel.id)
+    if voice_client is None:  # connected to another channel in this guild
+        await ctx.send(
+            "You have to be in the same voice channel as the bot to use this command"
+        )
+        return
+    station = get_station(name)
+    if tracks:
+        await station.call("enqueue", tracks)
+    if voice_client.is_playing() or voice_client.is_paused():  # switching stations
+        voice_client.stop()
+    voice_client.play(StationListener(name, station.connection))
+    tuned_in[ctx.guild.id] = name
+    status_for(ctx).post(f"Tuned in to `{name}`.")
+
+
+async def tracks_for_link(query: str, guild_id):
+    # a playlist link is queued unresolved, anything else is resolved to a single track
+    if "list" not in urllib.parse.parse_qs(urllib.parse.urlparse(query).query):
+        return [await resolve_track(query, PLAYBACK_MODE, guild_id=guild_id)]
+    info = await run_ytdl(YDL_PLAYLIST_OPTIONS, "extract", query)
+    entries = [
+        entry for entry in info.get("entries") or [] if entry and entry.get("id")
+    ]
+    if not entries:
+        raise yt_dlp.utils.DownloadError(f"ERROR: no videos in {query}")
+    metadata_cache.remember(entries)
+    metadata_cache.store_playlist(info)
+    return [
+        Track(entry["id"], entry.get("title"), duration=entry.get("duration"))
+        for entry in entries
+    ]
+
+
 @bot.command(name="current", aliases=["c"])
 async def current(ctx: commands.Context):
     try:
-        queue = queues[ctx.guild.id]
+        queue = players[ctx.guild.id].queue
     except KeyError:
         queue = None
 
@@ -350,18 +2860,70 @@ async def current(ctx: commands.Context):
         await ctx.send("No song is currently playing.")
     else:
         current_song = queue[0]
-        title = current_song[1]["title"]
-        video_id = current_song[1]["id"]
-        youtube_link = f"https://youtu.be/{video_id}"
+        title = current_song.title
+        youtube_link = current_song.link
+        position = format_position(players[ctx.guild.id].position)
+        if current_song.duration:
+            position += f" / {format_position(current_song.duration)}"
         embed_var = nextcord.Embed(color=COLOR, title="Currently Playing")
         embed_var.add_field(name="Title:", value=title, inline=False)
         embed_var.add_field(name="YouTube Link:", value=youtube_link, inline=False)
+        embed_var.add_field(name="Position:", value=position, inline=False)
         await ctx.send(embed=embed_var)
 
     if not await sense_checks(ctx):
         return
 
 
+@bot.command(name="seek", aliases=["se"])
+async def seek(ctx: commands.Context, position: str = None):
+    seconds = parse_position(position)
+    if seconds is None:
+        await ctx.send("Please provide a position like `90` or `1:30`.")
+        return
+    await seek_to(ctx, lambda _: seconds)
+
+
+@bot.command(name="forward", aliases=["fw"])
+async def forward(ctx: commands.Context, seconds: str = "10"):
+    seconds = parse_position(seconds)
+    if seconds is None:
+        await ctx.send("Please provide the number of seconds to skip ahead.")
+        return
+    await seek_to(ctx, lambda position: position + seconds)
+
+
+@bot.command(name="rewind", aliases=["rw"])
+async def rewind(ctx: commands.Context, seconds: str = "10"):
+    seconds = parse_position(seconds)
+    if seconds is None:
+        await ctx.send("Please provide the number of seconds to go back.")
+        return
+    await seek_to(ctx, lambda position: position - seconds)
+
+
+async def seek_to(ctx: commands.Context, target):
+    # target maps the current position to the one to seek to
+    try:
+        player = players[ctx.guild.id]
+    except KeyError:
+        await ctx.send("The bot isn't playing anything")
+        return
+    if not await sense_checks(ctx):
+        return
+
+    position = max(0.0, target(player.position))
+    playing = player.queue[0] if len(player.queue) > 0 else None
+    if playing is not None and playing.duration and position >= playing.duration:
+        await ctx.send("That's past the end of the song.")
+        return
+    position = await player.call("seek", position)
+    if position is None:
+        await ctx.send("The bot isn't playing anything")
+        return
+    await ctx.send(f"Playing from `{format_position(position)}`.")
+
+
 @bot.command(name="remove", aliases=["r"])
 async def remove(ctx: commands.Context, position: str):
     try:
@@ -373,17 +2935,16 @@ async def remove(ctx: commands.Context, position: str):
         return
 
     try:
-        queue = queues[ctx.guild.id]
+        player = players[ctx.guild.id]
     except KeyError:
         await ctx.send("The bot isn't playing anything")
         return
 
-    if position > len(queue):
+    removed_song = await player.call("remove", position)
+    if removed_song is None:
         await ctx.send("Invalid position.")
         return
-
-    removed_song = queue.pop(position)
-    await ctx.send(f"Removed song '{removed_song[1]['title']}' from the queue.")
+    await ctx.send(f"Removed song '{removed_song.title}' from the queue.")
 
 
 @bot.command(name="move", aliases=["m"])
@@ -400,14 +2961,14 @@ async def move(
     server_id = ctx.guild.id
 
     try:
-        # Get the queue for the server ID
-        queue = queues[server_id]
+        # Get the player for the server ID
+        player = players[server_id]
     except KeyError:
         await ctx.send("The bot isn't playing anything")
         return
 
     # Get the length of the queue
-    queue_length = len(queue)
+    queue_length = len(player.queue)
 
     try:
         # Convert queue_number and new_position to integers
@@ -433,8 +2994,9 @@ async def move(
         return
 
     # Move the song to the new position in the queue
-    song = queue.pop(queue_number - 1)
-    queue.insert(new_position - 1, song)
+    if not await player.call("move", queue_number - 1, new_position - 1):
+        await ctx.send("Invalid queue number or new position.")
+        return
 
     await ctx.send(
         f"Moved song from position {queue_number} to {new_position} in the queue."
@@ -444,25 +3006,16 @@ async def move(
 @bot.command(name="shuffle", aliases=["sh"])
 async def shuffle(ctx: commands.Context):
     try:
-        queue = queues[ctx.guild.id]
+        player = players[ctx.guild.id]
     except KeyError:
         await ctx.send("The bot isn't playing anything.")
         return
 
-    if len(queue) <= 1:
+    if len(player.queue) <= 1:
         await ctx.send("Not enough songs in the queue to shuffle.")
         return
 
-    current_song = queue[0]  # Get the currently playing song (position 0)
-    remaining_songs = queue[
-        1:
-    ]  # Get the remaining songs in the queue (excluding the currently playing song)
-    random.shuffle(remaining_songs)  # Shuffle the remaining songs
-    queue = [
-        current_song
-    ] + remaining_songs  # Create a new queue with the shuffled songs
-
-    queues[ctx.guild.id] = queue  # Update the queue in the dictionary
+    await player.call("shuffle")
 
     await ctx.send("Queue shuffled.")
 
@@ -470,15 +3023,12 @@ async def shuffle(ctx: commands.Context):
 @bot.command(name="clear", aliases=["cl"])
 async def clear(ctx: commands.Context):
     try:
-        queue = queues[ctx.guild.id]
+        player = players[ctx.guild.id]
     except KeyError:
         await ctx.send("The bot isn't playing anything")
         return
 
-    current_song = queue[0]  # Get the currently playing song
-    queues[ctx.guild.id] = [
-        current_song
-    ]  # Replace the queue with only the current song
+    await player.call("clear")  # Keep only the currently playing song
 
     await ctx.send("Queue cleared.")
 
@@ -490,44 +3040,438 @@ def get_voice_client_from_channel_id(channel_id: int):
     return None
 
 
-def after_track(error, connection, server_id):
-    if error is not None:
-        print(error)
+def parse_position(text: str):
+    # "90", "1:30" or "1:01:30" -> seconds, None if it's none of those
+    try:
+        parts = [float(part) for part in (text or "").split(":")]
+    except ValueError:
+        return None
+    if len(parts) > 3 or not all(0 <= part < math.inf for part in parts):
+        return None
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+
+def format_position(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return (
+        f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+    )
+
+
+def is_streamable(info) -> bool:
+    return bool(info.get("url")) and info.get("protocol", "https") in ("http", "https")
 
+
+def stream_expires_soon(track: Track) -> bool:
+    # googlevideo urls carry their expiry time, the url has to outlive the whole track
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(track.stream_url or "").query)
     try:
-        path, info = queues[server_id].pop(0)
+        expires = int(query["expire"][0])
+    except (KeyError, ValueError):
+        return False
+    return expires < time.time() + (track.duration or 0) + 60
+
+
+async def resolve_track(
+    query: str,
+    playback_mode: str,
+    announce=None,
+    guild_id=None,
+    priority: int = PRIORITY_USER,
+):
+    # returns a Track for the query, raises yt_dlp.utils.DownloadError if there is none
+    # a link we can read the video id from, or a search we've seen before, needs no network i/o if the audio is cached
+    video_id = youtube_video_id(query)
+    search = (
+        query if video_id is None and not urllib.parse.urlparse(query).scheme else None
+    )
+    if search is not None:
+        video_id, stale = metadata_cache.search(search)
+        if stale:
+            refresh_metadata(search)
+    cached = audio_cache.lookup(video_id, YDL_FORMAT) if video_id else None
+    if cached is not None:
+        info, stale = metadata_cache.video(video_id)
+        if stale:
+            refresh_metadata(f"https://youtu.be/{video_id}")
+        # the sidecar knows the file, the metadata cache may know a fresher title
+        fresher = {
+            k: v
+            for k, v in (info or {}).items()
+            if v is not None and k in ("title", "duration")
+        }
+        info = {**cached[1], **fresher}
+        if "acodec" not in info:  # cached before codecs were recorded
+            info["acodec"] = await probe_codec(cached[0])
+            audio_cache.update(cached[0], acodec=info["acodec"])
+        normalize_later(cached[0], info)
+        return Track.from_info(info, path=cached[0])
+
+    info = await run_ytdl(
+        YDL_OPTIONS, "extract", f"https://youtu.be/{video_id}" if video_id else query
+    )
+    if info is None:  # ignoreerrors swallows the actual error
+        raise yt_dlp.utils.DownloadError(f"ERROR: nothing found for {query}")
+    if "entries" in info:
+        if not info["entries"]:
+            raise yt_dlp.utils.DownloadError(f"ERROR: nothing found for {query}")
+        info = info["entries"][0]
+    metadata_cache.store(info, search=search)
+    if video_id is None:
+        cached = audio_cache.lookup(info["id"], YDL_FORMAT)
+        if cached is not None:
+            normalize_later(*cached)
+            return Track.from_info(info, path=cached[0])
+
+    if playback_mode == "stream" and is_streamable(info):
+        # ffmpeg reads the media url directly, so playback starts without waiting for a download
+        return Track.from_info(info, stream=True)
+
+    if announce is not None:
+        await announce(info)
+    if PROGRESSIVE_SECONDS > 0:
+        return await progressive_track(info, guild_id, priority)
+    path, info = await download_audio(info, guild_id, priority)
+    audio_cache.add(path, info)
+    return Track.from_info(info, path=path)
+
+
+async def progressive_track(info, guild_id=None, priority: int = PRIORITY_USER):
+    # returns once PROGRESSIVE_SECONDS of audio are downloaded, the rest downloads while it plays
+    download = asyncio.ensure_future(download_audio(info, guild_id, priority))
+    partial = PartialDownload(info, download)
+    # the format's bitrate in kbit/s, or failing that its average
+    kbps = info.get("abr") or info.get("tbr")
+    if not kbps and info.get("filesize") and info.get("duration"):
+        kbps = info["filesize"] / info["duration"] / 125
+    try:
+        await partial.buffered(int(PROGRESSIVE_SECONDS * (kbps or 160) * 125))
+    except asyncio.CancelledError:
+        # the download goes on regardless, and nobody would be left to release what it adds to the cache
+        partial.release()
+        raise
+    if not partial.finished.is_set():
+        return Track.from_info(info, download=partial)
+    if partial.track is None:
+        download.result()  # raises why it failed
+    return partial.track
+
+
+async def download_audio(info, guild_id=None, priority: int = PRIORITY_USER):
+    # single flight: whoever asks for a video that is already being downloaded waits for that download
+    global coalesced_downloads
+    key = (info["id"], YDL_FORMAT)
+    try:
+        download = downloads_in_flight[key]
+        coalesced_downloads += 1
+        download_scheduler.promote(key, priority)
     except KeyError:
-        return  # probably got disconnected
+        download = downloads_in_flight[key] = asyncio.ensure_future(
+            download_scheduler.run(guild_id, priority, lambda: _download(info), key)
+        )
+        download.add_done_callback(lambda _: downloads_in_flight.pop(key, None))
+    # shielded so one requester giving up doesn't cancel the download for everyone else
+    return await asyncio.shield(download)
+
+
+async def _download(info):
+    # another shard downloading the same video is waited for, then its file is used
+    video_id = info["id"]
+    while not audio_cache.lock_download(video_id, YDL_FORMAT):
+        await asyncio.sleep(0.25)
+    try:
+        found = audio_cache.find(video_id, YDL_FORMAT)
+        if found is not None:
+            return found
+        info = await run_ytdl(YDL_OPTIONS, "download", info) or info
+        # the top level info describes the format as downloaded, not the file the postprocessor left behind
+        downloaded = (info.get("requested_downloads") or [{}])[-1]
+        info = {**info, "ext": downloaded.get("ext", info["ext"])}
+        path = audio_cache.path_for(info, YDL_FORMAT)
+        if not os.path.exists(path):
+            raise yt_dlp.utils.DownloadError(f"ERROR: failed to download {video_id}")
+        info["acodec"] = await probe_codec(path)
+        audio_cache.write_sidecar(path, info)
+        normalize_later(path, info)
+        return path, info
+    finally:
+        audio_cache.unlock_download(video_id, YDL_FORMAT)
+
+
+async def probe_codec(path: str):
+    # what's actually in the file, yt_dlp's acodec is from before any conversion
+    probed = await nextcord.FFmpegOpusAudio.probe(path)
+    return probed[0] if probed else None
+
+
+LOUDNESS_TOLERANCE = 0.5  # dB nobody hears, not worth a transcode
+MAX_BOOST = 12.0  # dB, past that a quiet track is mostly noise
+NORMALIZED_BITRATE = 96  # kbit/s, for a file whose own bitrate isn't known
+REWRITE_MUXERS = {"opus": "opus", "ogg": "ogg", "webm": "webm"}  # {ext: muxer for opus}
+
+
+def normalize_later(path: str, info):
+    # a file is measured and normalized once, in the background, the first time it's downloaded or played
+    if (
+        LOUDNESS_TARGET is None
+        or info.get("gain") is not None
+        or path in loudness_pending
+        or path in loudness_skipped
+    ):
+        return
+    loudness_pending.add(path)
+    bot.loop.create_task(normalize_loudness(path))
+
+
+async def normalize_loudness(path: str):
+    # measures the file and writes the gain into it, so playing it normalized is still a copy of the opus packets
+    # until then, playback_gain has ffmpeg apply the gain while it plays
+    audio_cache.acquire(path)  # not evicted while we're at it
+    try:
+        async with loudness_slots:
+            while not audio_cache.lock_rewrite(path):
+                await asyncio.sleep(1)
+            started = time.perf_counter()
+            try:
+                if not await _normalize_loudness(path):
+                    loudness_skipped.add(path)
+            finally:
+                audio_cache.unlock_rewrite(path)
+                normalize_seconds.observe(time.perf_counter() - started)
+    finally:
+        loudness_pending.discard(path)
+        audio_cache.release(path)
+
+
+async def _normalize_loudness(path: str) -> bool:
+    # false if there's nothing more to do about the file this run
+    info = audio_cache.reread(path)  # another shard may have done it already
+    if info is None or info.get("gain") is not None:
+        return info is not None
+    if info.get("loudness") is None:
+        measured = await measure_loudness(path)
+        if measured is None:
+            return False
+        info = audio_cache.update(path, loudness=measured[0], peak=measured[1])
+        if info is None:
+            return False
+    gain = loudness_gain(info)
+    if abs(gain) < LOUDNESS_TOLERANCE:
+        audio_cache.update(path, gain=0.0)
+        return True
+    muxer = REWRITE_MUXERS.get(path.rsplit(".", 1)[-1])
+    if muxer is None or not await rewrite_with_gain(
+        path, gain, muxer, file_bitrate(path, info)
+    ):
+        return False
+    audio_cache.update(path, gain=gain)
+    print(f"normalized {os.path.basename(path)} by {gain:+.1f} dB")
+    return True
+
+
+def file_bitrate(path: str, info) -> int:
+    # kbit/s the file was encoded at, so the rewrite is about as big as the original
+    # the size over the duration is what the file really has, yt_dlp's abr is of the format before any conversion
+    kbps = info.get("abr")
+    try:
+        if info.get("duration"):
+            kbps = os.path.getsize(path) / info["duration"] / 125
+    except OSError:
+        pass
+    # the range libopus encodes at
+    return min(max(round(kbps or NORMALIZED_BITRATE), 6), 510)
+
+
+def loudness_gain(info) -> float:
+    # dB that bring a measured file to LOUDNESS_TARGET without pushing its peaks over -1 dBTP
+    gain = min(LOUDNESS_TARGET - info["loudness"], -1.0 - info["peak"], MAX_BOOST)
+    return gain if math.isfinite(gain) else 0.0
+
+
+def playback_gain(track: Track):
+    # dB ffmpeg has to apply while playing a track, None when it plays as it is
+    if LOUDNESS_TARGET is None or track.path is None:
+        return None
+    info = audio_cache.info(track.path)
+    if info is None or info.get("loudness") is None:
+        return None
+    if info.get("gain") is None:
+        # another shard may have written the gain into the file since
+        info = audio_cache.reread(track.path) or info
+    gain = loudness_gain(info) - (info.get("gain") or 0.0)
+    return gain if abs(gain) >= LOUDNESS_TOLERANCE else None
+
+
+def _lower_priority(pid: int):
+    # the analysis shares the cpu with the ffmpegs that are playing
+    # set from out here, a preexec_fn isn't safe in a process with threads
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, 10)
+    except OSError:
+        pass  # already exited
+
+
+async def run_ffmpeg(*args):
+    # returns what ffmpeg printed, or None if it failed
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-nostdin",
+            *args,
+            stdout=sp.DEVNULL,
+            stderr=sp.PIPE,
+        )
+    except OSError as err:
+        print(f"failed to run ffmpeg: {err}")
+        return None
+    if hasattr(os, "setpriority"):
+        _lower_priority(process.pid)
+    _, output = await process.communicate()
+    output = output.decode(errors="replace")
+    if process.returncode != 0:
+        print(f"ffmpeg {shlex.join(args)} failed: {output[-500:]}")
+        return None
+    return output
+
+
+async def measure_loudness(path: str):
+    # integrated loudness in LUFS and true peak in dBTP, from one pass of the loudnorm filter
+    output = await run_ffmpeg(
+        "-i", path, "-vn", "-af", "loudnorm=print_format=json", "-f", "null", "-"
+    )
+    if output is None:
+        return None
+    try:
+        measured = json.loads(output[output.rindex("{") : output.rindex("}") + 1])
+        return float(measured["input_i"]), float(measured["input_tp"])
+    except (ValueError, KeyError):
+        print(f"ffmpeg didn't measure the loudness of {path}")
+        return None
 
-    loop_mode = loop_modes.get(server_id, "off")
-    if loop_mode == "single":
-        queues[server_id].insert(0, (path, info))
-    elif loop_mode == "all":
-        queues[server_id].append((path, info))
 
-    if path not in [i[0] for i in queues[server_id]]:
+async def rewrite_with_gain(path: str, gain: float, muxer: str, kbps: int) -> bool:
+    # encodes the file once more with the gain applied and puts it in place of the original
+    # whoever has the original open keeps reading it
+    rewritten = f"{path}.rewrite"
+    try:
+        output = await run_ffmpeg(
+            "-y",
+            "-i",
+            path,
+            "-vn",
+            "-af",
+            f"volume={gain:.2f}dB",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            f"{kbps}k",
+            "-f",
+            muxer,
+            rewritten,
+        )
+        if output is None:
+            return False
+        os.replace(rewritten, path)
+        return True
+    except OSError as err:
+        print(f"failed to replace {path}: {err}")
+        return False
+    finally:
         try:
-            os.remove(path)
+            os.remove(rewritten)
         except FileNotFoundError:
             pass
 
-    if loop_mode == "off" and len(queues[server_id]) == 0:
-        # No more tracks in the queue and loop mode is "Off"
-        queues.pop(server_id)  # directory will be deleted on disconnect
-        asyncio.run_coroutine_threadsafe(safe_disconnect(connection), bot.loop).result()
-    else:
+
+def refresh_metadata(query: str):
+    # stale-while-revalidate, whoever asked already got the stale answer
+    if query in metadata_refreshes:
+        return
+    metadata_refreshes.add(query)
+
+    async def refresh():
         try:
-            connection.play(
-                nextcord.FFmpegOpusAudio(queues[server_id][0][0]),
-                after=lambda error=None, connection=connection, server_id=server_id: after_track(
-                    error, connection, server_id
-                ),
+            info = await run_ytdl(YDL_OPTIONS, "extract", query)
+            if info is not None and "entries" in info:
+                info = info["entries"][0] if info["entries"] else None
+            if info is not None:
+                search = None if urllib.parse.urlparse(query).scheme else query
+                metadata_cache.store(info, search=search)
+        except yt_dlp.utils.DownloadError as err:
+            print(f"failed to refresh metadata for {query}: {err}")
+        finally:
+            metadata_refreshes.discard(query)
+
+    bot.loop.create_task(refresh())
+
+
+def create_audio_source(track: Track, start: float = 0.0):
+    # an opus codec makes nextcord copy the packets (-c:a copy) instead of decoding and encoding them again
+    # a start seeks in the input, in a local file that's no slower than starting at 0
+    seek = f"-ss {start:.2f}" if start else None
+    if track.download is not None and track.download.track is not None:
+        track = track.download.track  # already downloaded
+    if track.download is not None:
+        # a pipe can't seek, ffmpeg drops what comes before the start instead
+        return GrowingFileAudio(
+            GrowingFile(track.download, track.id), options=seek, codec=track.codec
+        )
+    if track.path is not None:
+        gain = playback_gain(track)
+        if gain is not None:  # measured, but not rewritten yet
+            return nextcord.FFmpegOpusAudio(
+                track.path, before_options=seek, options=f"-af volume={gain:.2f}dB"
             )
-        except IndexError:  # that was the last item in queue
-            queues.pop(server_id)  # directory will be deleted on disconnect
-            asyncio.run_coroutine_threadsafe(
-                safe_disconnect(connection), bot.loop
-            ).result()
+        return nextcord.FFmpegOpusAudio(
+            track.path, before_options=seek, codec=track.codec
+        )
+    before_options = STREAM_BEFORE_OPTIONS
+    if track.stream_headers:
+        before_options += f" -headers {shlex.quote(track.stream_headers)}"
+    if seek:
+        before_options += f" {seek}"
+    return nextcord.FFmpegOpusAudio(
+        track.stream_url, before_options=before_options, codec=track.codec
+    )
+
+
+def ffmpeg_cpu_seconds(source):
+    # user + system time of the ffmpeg process behind a source, None where there is no /proc
+    try:
+        with open(f"/proc/{source._process.pid}/stat") as file:
+            # the command name in parentheses may contain spaces, the fields after it don't
+            fields = file.read().rsplit(")", 1)[1].split()
+    except (AttributeError, OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def release_tracks(tracks):
+    for track in tracks:
+        if track.path is not None:
+            audio_cache.release(track.path)
+        elif track.download is not None:
+            track.download.release()
+
+
+def youtube_video_id(query: str):
+    parsed_query = urllib.parse.urlparse(query)
+    if parsed_query.netloc in ("youtu.be", "www.youtu.be"):
+        video_id = parsed_query.path.lstrip("/")
+    elif parsed_query.netloc.endswith("youtube.com"):
+        if parsed_query.path == "/watch":
+            video_id = urllib.parse.parse_qs(parsed_query.query).get("v", [""])[0]
+        else:
+            video_id = re.sub(r"^/(shorts|live|embed)/", "", parsed_query.path)
+    else:
+        return None
+    return video_id if re.fullmatch(r"[A-Za-z0-9_-]{11}", video_id) else None
 
 
 async def safe_disconnect(connection):
@@ -535,6 +3479,86 @@ async def safe_disconnect(connection):
         await connection.disconnect()
 
 
+# each ytdl worker keeps its own YoutubeDL per set of options, so the extractors, http session and
+# cookies are set up once per worker instead of once per track, and no instance is shared between threads
+ytdl_local = threading.local()
+
+
+def _check_cancelled(progress):
+    # raising from a progress hook is the only way to interrupt a running yt_dlp download
+    if ytdl_local.cancelled.is_set():
+        raise yt_dlp.utils.DownloadCancelled("cancelled")
+
+
+def ytdl_key(options) -> str:
+    return json.dumps(options, sort_keys=True, default=repr)
+
+
+def pooled_ytdl(options) -> yt_dlp.YoutubeDL:
+    instances = ytdl_local.__dict__.setdefault("instances", {})
+    key = ytdl_key(options)
+    if key not in instances:
+        instances[key] = yt_dlp.YoutubeDL(
+            {**options, "progress_hooks": [_check_cancelled]}
+        )
+    return instances[key]
+
+
+def _run_ytdl_job(options, action, query, cancelled: threading.Event):
+    if cancelled.is_set():
+        raise yt_dlp.utils.DownloadCancelled("cancelled before it started")
+
+    ytdl_local.cancelled = cancelled
+    ydl = pooled_ytdl(options)
+    try:
+        if action == "download" and isinstance(query, dict):
+            # already extracted, so this doesn't have to look the video up again
+            return ydl.process_ie_result(query, download=True)
+        return ydl.extract_info(query, download=action == "download")
+    except yt_dlp.utils.DownloadCancelled:
+        raise
+    except Exception:
+        # don't keep reusing an instance that might have been left half way through something
+        ytdl_local.instances.pop(ytdl_key(options), None)
+        ydl.close()
+        raise
+
+
+async def run_ytdl(options, action: str, query, timeout: float = None):
+    # action is either "extract" (metadata only) or "download", both return the info dict
+    # query is a url or search, downloads also take an info dict returned by a previous extraction
+    if timeout is None:
+        timeout = YTDL_TIMEOUT
+    cancelled = threading.Event()
+    job = asyncio.get_running_loop().run_in_executor(
+        ytdl_executor, _run_ytdl_job, options, action, query, cancelled
+    )
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(job, timeout)
+    except asyncio.TimeoutError:
+        cancelled.set()
+        raise yt_dlp.utils.DownloadError(
+            f"ERROR: gave up after {timeout:.0f} seconds"
+        ) from None
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+    finally:
+        histogram = download_seconds if action == "download" else extract_seconds
+        histogram.observe(time.perf_counter() - started)
+
+
+async def not_tuned_in(ctx: commands.Context) -> bool:
+    # a queue can't play on a voice client that listens to a station
+    if ctx.guild.id not in tuned_in:
+        return True
+    await ctx.send(
+        f"The bot is tuned in to `{tuned_in[ctx.guild.id]}` here, use exit before queueing"
+    )
+    return False
+
+
 async def sense_checks(ctx: commands.Context, voice_state=None) -> bool:
     if voice_state is None:
         voice_state = ctx.author.voice
@@ -542,10 +3566,9 @@ async def sense_checks(ctx: commands.Context, voice_state=None) -> bool:
         await ctx.send("You have to be in a voice channel to use this command")
         return False
 
-    if (
-        bot.user.id not in [member.id for member in ctx.author.voice.channel.members]
-        and ctx.guild.id in queues.keys()
-    ):
+    if bot.user.id not in [
+        member.id for member in ctx.author.voice.channel.members
+    ] and (ctx.guild.id in players or ctx.guild.id in tuned_in):
         await ctx.send(
             "You have to be in the same voice channel as the bot to use this command"
         )
@@ -564,14 +3587,9 @@ async def on_voice_state_update(
     if before.channel is not None and after.channel is None:  # disconnected from vc
         # clean up
         server_id = before.channel.guild.id
-        try:
-            queues.pop(server_id)
-        except KeyError:
-            pass
-        try:
-            shutil.rmtree(f"./dl/{server_id}/")
-        except FileNotFoundError:
-            pass
+        # downloaded files stay in the shared cache, only our references to them go
+        stop_player(server_id)
+        tuned_in.pop(server_id, None)
 
 
 @bot.event
@@ -588,17 +3606,238 @@ async def on_command_error(
             )
         return
 
-    # we ran out of handlable exceptions, re-start. type_ and value are None for these
-    sys.stderr.write(f"unhandled command error raised, {err=}")
-    sp.run(["./restart"])
+    # we ran out of handlable exceptions, so this shard exits and the supervisor starts it again
+    global exit_reason
+    exit_reason = f"unhandled command error raised, {err=}"
+    await bot.close()
 
 
 @bot.event
 async def on_ready():
+    global restored_state
     print(f"logged in successfully as {bot.user.name}")
+    loop_watchdog.start()
+    await start_metrics_server()
+    # on_ready fires again after every reconnect, only the first one restores
+    state, restored_state = restored_state, None
+    if state:
+        await restore_players(state)
+
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT == 0 or metrics_server is not None:
+        return
+    port = METRICS_PORT + (SHARD_ID or 0)  # one port after the other for the shards
+    try:
+        metrics_server = await asyncio.start_server(serve_metrics, "127.0.0.1", port)
+    except OSError as err:
+        print(f"failed to serve metrics on port {port}: {err}")
+        return
+    print(f"serving metrics on http://127.0.0.1:{port}/metrics")
+
+
+async def restore_players(state):
+    # rejoins the voice channels the last run was playing in, with the queues it had
+    # the tracks come back unresolved, whatever is still in the audio cache plays without a download
+    for server_id, saved in state.items():
+        channel = bot.get_channel(saved["channel"])
+        if channel is None or len(saved["queue"]) == 0:
+            journal.record(server_id, "end")
+            continue
+        try:
+            connection = await channel.connect()
+        except Exception as err:
+            # e.g. no permission to join anymore, one guild failing doesn't keep the rest from coming back
+            print(f"failed to rejoin {saved['channel']}: {err!r}")
+            journal.record(server_id, "end")
+            continue
+        player = players[server_id] = GuildPlayer(server_id, connection)
+        video_id, position = saved["position"] or (None, 0.0)
+        start = position if saved["queue"][0].id == video_id else 0.0
+        # posted rather than awaited, so one guild's head track downloading doesn't hold up the next guild
+        player.post("set_loop", saved["loop"])
+        player.post("enqueue", list(saved["queue"]), None, start)
+        print(f"restored {len(saved['queue'])} tracks in {channel.name}")
+    journal.snapshot()
+
+
+@bot.command(name="stats", aliases=["cache"])
+async def stats(ctx: commands.Context):
+    cache_stats = audio_cache.stats()
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = cache_stats["hits"] / lookups * 100 if lookups else 0
+    lines = [
+        f"Cache: `{cache_stats['files']}` files, "
+        f"`{cache_stats['bytes'] / 1024 / 1024:.1f}` MB of "
+        f"`{audio_cache.max_bytes / 1024 / 1024:.0f}` MB, "
+        f"`{cache_stats['hits']}` hits, `{cache_stats['misses']}` misses "
+        f"({hit_rate:.0f}% hit rate), "
+        f"`{coalesced_downloads}` downloads shared between requests, "
+        f"`{cache_stats['normalized']}` files loudness normalized",
+        f"Downloads: `{download_scheduler.running}`/`{download_scheduler.concurrency}` running, "
+        + ", ".join(
+            f"{name} `{waits['waiting']}` waiting (avg `{waits['average_wait']:.1f}`s, "
+            f"max `{waits['max_wait']:.1f}`s)"
+            for name, waits in download_scheduler.stats().items()
+        ),
+    ]
+    if transition_gaps:
+        lines.append(
+            f"Gap between tracks: avg `{sum(transition_gaps) / len(transition_gaps) * 1000:.0f}` ms, "
+            f"max `{max(transition_gaps) * 1000:.0f}` ms over the last `{len(transition_gaps)}`"
+        )
+    lag = loop_watchdog.percentiles()
+    if lag is not None:
+        lines.append(
+            "Event loop lag: "
+            + ", ".join(
+                f"{name} `{value * 1000:.1f}` ms" for name, value in lag.items()
+            )
+            + f", `{len(loop_watchdog.stalls)}` recent stalls over "
+            f"`{loop_watchdog.threshold * 1000:.0f}` ms"
+        )
+    for copied in (True, False):
+        usage = [(cpu, audio) for c, cpu, audio in ffmpeg_cpu_usage if c == copied]
+        if usage:
+            cpu = sum(cpu for cpu, _ in usage)
+            audio = sum(audio for _, audio in usage)
+            lines.append(
+                f"FFmpeg ({'opus copied' if copied else 'transcoded'}): "
+                f"`{cpu / audio * 100 if audio else 0:.2f}`% of a core, "
+                f"`{cpu / len(usage):.2f}`s cpu per stream over the last `{len(usage)}`"
+            )
+    if SHARD_COUNT > 1:
+        lines.append(
+            f"Shard: `{SHARD_ID}` of `{SHARD_COUNT}` with `{len(bot.guilds)}` servers, "
+            "the numbers above are for this shard only"
+        )
+    await ctx.send("\n".join(lines))
+
+
+async def serve_metrics(reader, writer):
+    # just enough http for a prometheus scrape or curl
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        path = request.split(b" ", 2)[1]
+        if path == b"/metrics":
+            status, body = "200 OK", (await render_metrics()).encode()
+        else:
+            status, body = "404 Not Found", b"try /metrics\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (
+        asyncio.TimeoutError,
+        asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError,
+        IndexError,
+    ):
+        pass
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def render_metrics() -> str:
+    lines = []
+    for histogram in (
+        extract_seconds,
+        download_seconds,
+        ffmpeg_start_seconds,
+        first_audio_seconds,
+        track_gap_seconds,
+        loop_lag_seconds,
+        normalize_seconds,
+    ):
+        lines += histogram.render()
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    cache_stats = audio_cache.stats()
+    metric(
+        "youtubebot_voice_clients",
+        "gauge",
+        "Voice channels the bot is connected to.",
+        [("", len(bot.voice_clients))],
+    )
+    metric(
+        "youtubebot_queue_length",
+        "gauge",
+        "Tracks queued per guild (or radio station), including the playing one.",
+        [
+            (f'{{guild="{server_id}"}}', len(player.queue))
+            for server_id, player in [*players.items(), *stations.items()]
+        ],
+    )
+    # walking the directory is file system i/o, so it stays off the event loop
+    metric(
+        "youtubebot_disk_bytes",
+        "gauge",
+        "Bytes used by everything under ./dl.",
+        [("", await bot.loop.run_in_executor(None, disk_usage, "./dl"))],
+    )
+    metric(
+        "youtubebot_cache_lookups_total",
+        "counter",
+        "Audio cache lookups.",
+        [
+            ('{result="hit"}', cache_stats["hits"]),
+            ('{result="miss"}', cache_stats["misses"]),
+        ],
+    )
+    metric(
+        "youtubebot_cache_normalized_files",
+        "gauge",
+        "Cached files whose loudness gain is written into them.",
+        [("", cache_stats["normalized"])],
+    )
+    metric(
+        "youtubebot_coalesced_downloads_total",
+        "counter",
+        "Requests that joined a download already in flight.",
+        [("", coalesced_downloads)],
+    )
+    metric(
+        "youtubebot_download_failures_total",
+        "counter",
+        "Failed requests reported back to a channel.",
+        [("", download_failures)],
+    )
+    metric(
+        "youtubebot_downloads_waiting",
+        "gauge",
+        "Downloads waiting for a slot, per priority.",
+        [
+            (f'{{priority="{name}"}}', waits["waiting"])
+            for name, waits in download_scheduler.stats().items()
+        ],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def disk_usage(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # deleted while we were looking
+    return total
 
 
 async def notify_about_failure(ctx: commands.Context, err: yt_dlp.utils.DownloadError):
+    global download_failures
+    download_failures += 1
     if BOT_REPORT_DL_ERROR:
         # remove shell colors for nextcord message
         sanitized = re.compile(r"\x1b[^m]*m").sub("", err.msg).strip()